@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+
+
+# admin levels by ip: a json snapshot plus a journal with one json line per change since the snapshot
+# every change is appended and synced before it returns, the snapshot is only ever replaced by an atomic rename
+# reads are a single dict lookup and need no lock, changes are serialized by one
+class AdminStore:
+    def __init__(self, path, persist=True, compact_after=1000):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.persist = persist
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+
+        self.levels = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as f:
+                self.levels = json.load(f)
+
+        self.journal_entries = 0
+        valid_end = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # a line cut off by a crash, everything before it is intact
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    self.levels[change['ip']] = change['level']
+                    self.journal_entries += 1
+                    valid_end += len(line)
+
+        self.journal = None
+        if persist:
+            self.journal = open(self.journal_path, 'ab')
+            # new changes must not be glued to the cut off line
+            self.journal.truncate(valid_end)
+
+    def __contains__(self, ip):
+        return ip in self.levels
+
+    def get(self, ip, default=None):
+        return self.levels.get(ip, default)
+
+    def set(self, ip, level):
+        with self.lock:
+            if self.levels.get(ip) == level and ip in self.levels:
+                return
+            self.levels[ip] = level
+            if self.journal is None:
+                return
+            self.journal.write((json.dumps({'ip': ip, 'level': level}) + '\n').encode('utf8'))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_entries += 1
+            if self.journal_entries >= self.compact_after:
+                self.compact()
+
+    # writes a new snapshot next to the old one, renames it over it and only then empties the journal,
+    # a crash in between replays a journal that is already part of the snapshot, which changes nothing
+    def compact(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf8') as f:
+            json.dump(self.levels, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        self.journal.truncate(0)
+        self.journal.seek(0)
+        self.journal_entries = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal is None:
+                return
+            if self.journal_entries:
+                self.compact()
+            self.journal.close()
+            self.journal = None
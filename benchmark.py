@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import resource
+import selectors
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from protocol import FrameDecoder, SPLITTER_LENGTH
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)):
+        result[name] = round(values[min(len(values) - 1, int(len(values) * fraction))], 3)
+    result['max'] = round(values[-1], 3)
+    result['mean'] = round(sum(values) / len(values), 3)
+    return result
+
+
+# cpu seconds, rss and thread count of a local process read from /proc
+def process_stats(pid):
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status', 'r') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    stats = {
+        'cpu_seconds': (int(fields[11]) + int(fields[12])) / ticks,
+        'rss_kb': int(status['VmRSS'].split()[0]),
+        'peak_rss_kb': int(status['VmHWM'].split()[0]),
+        'threads': int(status['Threads']),
+        'processes': 1
+    }
+
+    # a multi worker server is the supervisor plus its worker processes
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children', 'r') as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        child_stats = process_stats(child)
+        if child_stats is not None:
+            for key in stats:
+                stats[key] += child_stats[key]
+    return stats
+
+
+class SyntheticClient:
+    def __init__(self, index, address, observer):
+        self.index = index
+        self.name = f'bench{index}'
+        self.observer = observer
+        self.state = 'connecting'
+        self.decoder = None
+        self.splitter = None
+        self.pending = b''
+        self.bytes_received = 0
+        self.messages_received = 0
+        self.connect_started = time.perf_counter()
+        self.join_time = None
+        self.closed = False
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.connect_ex(address)
+
+    def send_text(self, content):
+        data = f'text{self.splitter}{content}{self.splitter}end{self.splitter}'.encode('utf8')
+        try:
+            self.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return False
+        return True
+
+
+# speaks the real handshake with many clients from one selector loop and measures broadcast latency at observers
+class LoadGenerator:
+    def __init__(self, host, port, clients, observers, rate, duration, message_size, connect_batch, join_timeout):
+        self.address = (host, port)
+        self.client_count = clients
+        self.observer_count = observers
+        self.rate = rate
+        self.duration = duration
+        self.message_size = message_size
+        self.connect_batch = connect_batch
+        self.join_timeout = join_timeout
+
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.latencies = []
+        self.join_times = []
+        self.failed = 0
+        self.messages_sent = 0
+        self.send_blocked = 0
+
+    def run(self):
+        started = time.perf_counter()
+        self.connect_all()
+        joined = time.perf_counter()
+
+        members = [client for client in self.clients if client.state == 'joined']
+        sent_window_start = time.perf_counter()
+        if members:
+            self.send_load(members)
+        sending_done = time.perf_counter()
+        self.poll_until(time.perf_counter() + 1)
+
+        for client in self.clients:
+            self.close(client)
+
+        observers = [client for client in members if client.observer]
+        expected = self.messages_sent * len(observers)
+        observed = sum(client.messages_received for client in observers)
+        return {
+            'clients': self.client_count,
+            'joined': len(members),
+            'failed': self.failed,
+            'join_phase_seconds': round(joined - started, 3),
+            'join_ms': percentiles(self.join_times),
+            'latency_ms': percentiles(self.latencies),
+            'messages_sent': self.messages_sent,
+            'send_blocked': self.send_blocked,
+            'send_rate': round(self.messages_sent / max(sending_done - sent_window_start, 1e-9), 1),
+            'observed_deliveries': observed,
+            'delivery_ratio': round(observed / expected, 4) if expected else None,
+            'fanout_deliveries_per_second': round(self.messages_sent * len(members) / max(sending_done - sent_window_start, 1e-9), 1),
+            'bytes_received': sum(client.bytes_received for client in self.clients)
+        }
+
+    def connect_all(self):
+        deadline = time.perf_counter() + self.join_timeout
+        while len(self.clients) < self.client_count or any(client.state != 'joined' for client in self.clients if client.state != 'failed'):
+            if time.perf_counter() > deadline:
+                break
+            # keep at most connect_batch connections waiting for the splitter so the listen backlog never overflows
+            connecting = sum(1 for client in self.clients if client.state == 'connecting')
+            for _ in range(min(self.connect_batch - connecting, self.client_count - len(self.clients))):
+                client = SyntheticClient(len(self.clients), self.address, len(self.clients) < self.observer_count)
+                self.clients.append(client)
+                self.selector.register(client.sock, selectors.EVENT_READ, client)
+            self.poll(0.01)
+
+        for client in self.clients:
+            if client.state not in ('joined', 'failed'):
+                client.state = 'failed'
+                self.failed += 1
+
+    def send_load(self, members):
+        interval = 1 / self.rate
+        end = time.perf_counter() + self.duration
+        next_send = time.perf_counter()
+        padding = 'x' * self.message_size
+        turn = 0
+        while time.perf_counter() < end:
+            now = time.perf_counter()
+            while next_send <= now:
+                client = members[turn % len(members)]
+                turn += 1
+                if client.send_text(f'bench {time.perf_counter_ns()} {padding}'):
+                    self.messages_sent += 1
+                else:
+                    self.send_blocked += 1
+                next_send += interval
+            self.poll(max(0, min(next_send - time.perf_counter(), 0.01)))
+
+    def poll_until(self, deadline):
+        while time.perf_counter() < deadline:
+            self.poll(0.05)
+
+    def poll(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            client = key.data
+            try:
+                data = client.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                self.fail(client)
+                continue
+            client.bytes_received += len(data)
+            self.handle_data(client, data)
+
+    def fail(self, client):
+        if client.state != 'failed':
+            client.state = 'failed'
+            self.failed += 1
+        self.close(client)
+
+    def close(self, client):
+        if not client.closed:
+            client.closed = True
+            self.selector.unregister(client.sock)
+            client.sock.close()
+
+    def handle_data(self, client, data):
+        if client.state == 'connecting':
+            # the splitter and the hello frame usually arrive in the same read
+            client.pending += data
+            if len(client.pending) < SPLITTER_LENGTH:
+                return
+            client.splitter = client.pending[:SPLITTER_LENGTH].decode('utf8')
+            client.decoder = FrameDecoder(client.splitter)
+            client.state = 'hello'
+            data = client.pending[SPLITTER_LENGTH:]
+            client.pending = b''
+
+        # most clients only drain their socket, observers decode every frame
+        if client.state == 'joined' and not client.observer:
+            return
+
+        now = time.perf_counter_ns()
+        for message_type, content in client.decoder.feed(data):
+            if client.state == 'hello' and message_type == 'hello':
+                client.send_text(client.name)
+                client.state = 'naming'
+            elif client.state == 'naming' and content.startswith('Welcome'):
+                client.state = 'joined'
+                client.join_time = (time.perf_counter() - client.connect_started) * 1000
+                self.join_times.append(client.join_time)
+            elif client.state == 'joined' and message_type in ('text', 'room'):
+                if message_type == 'room':
+                    content = content.split(' ', 1)[1]
+                parts = content.split(' ', 3)
+                if len(parts) > 2 and parts[1] == 'bench':
+                    client.messages_received += 1
+                    self.latencies.append((now - int(parts[2])) / 1e6)
+
+
+# directory is the checkout the server runs from, so another build can be started on the same config
+# returns the process and a temporary directory holding its config and everything it writes, removed by the caller
+# overrides are config keys set over the benchmark defaults
+def spawn_server(mode, port, base_config, workers, directory='.', overrides=None):
+    with open(base_config, 'r') as f:
+        config = json.load(f)
+    config['network_mode'] = mode
+    config['port'] = port
+    config['workers'] = workers
+    config['log_file'] = ''
+    # most benchmark clients never answer pings
+    config['idle_timeout'] = 0
+    # all load comes from one ip, the rate limits would be measured instead of the server
+    for limits in config['rate_limits'].values():
+        for key in limits:
+            if key.endswith('_per_second'):
+                limits[key] = 0
+    config.update(overrides or {})
+
+    run_directory = tempfile.mkdtemp(prefix='chat-server-')
+    config['history_dir'] = os.path.join(run_directory, 'history')
+    config['search_index_file'] = os.path.join(run_directory, 'search.idx')
+    config['scrollback_spill_file'] = os.path.join(run_directory, 'server_scrollback.txt')
+    config['bus_path'] = os.path.join(run_directory, 'cluster.sock')
+    # the spawned server journals and compacts its own copy of the admins
+    admins_file = os.path.join(directory, config['admins_file'])
+    config['admins_file'] = os.path.join(run_directory, 'admins.json')
+    for suffix in ('', '.journal'):
+        if os.path.exists(admins_file + suffix):
+            shutil.copyfile(admins_file + suffix, config['admins_file'] + suffix)
+    config_path = os.path.join(run_directory, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+    process = subprocess.Popen([sys.executable, 'headless_server.py', config_path], cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process, run_directory
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load generator and benchmark for the chat server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=25565)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--observers', type=int, default=10, help='clients that decode every frame to measure latency')
+    parser.add_argument('--rate', type=float, default=200, help='chat messages per second across all clients')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--message-size', type=int, default=32)
+    parser.add_argument('--connect-batch', type=int, default=50)
+    parser.add_argument('--join-timeout', type=float, default=60)
+    parser.add_argument('--spawn', choices=['threaded', 'selector'], help='start a headless server in this mode for the run')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the spawned server')
+    parser.add_argument('--config', default='data/config.json', help='config the spawned server is based on')
+    parser.add_argument('--server-pid', type=int, help='pid of an already running server to sample cpu and rss from')
+    parser.add_argument('--output', help='write the json result to this file instead of stdout')
+    args = parser.parse_args()
+
+    raise_file_limit()
+
+    process = None
+    run_directory = None
+    server_pid = args.server_pid
+    if args.spawn:
+        process, run_directory = spawn_server(args.spawn, args.port, args.config, args.workers)
+        server_pid = process.pid
+
+    server_before = process_stats(server_pid) if server_pid else None
+    own_before = resource.getrusage(resource.RUSAGE_SELF)
+
+    generator = LoadGenerator(args.host, args.port, args.clients, args.observers, args.rate, args.duration, args.message_size, args.connect_batch, args.join_timeout)
+    result = generator.run()
+
+    own_after = resource.getrusage(resource.RUSAGE_SELF)
+    result['generator_cpu_seconds'] = round(own_after.ru_utime + own_after.ru_stime - own_before.ru_utime - own_before.ru_stime, 3)
+    result['mode'] = args.spawn
+    result['config'] = {key: value for key, value in vars(args).items() if key != 'output'}
+
+    if server_pid:
+        server_after = process_stats(server_pid)
+        if server_before and server_after:
+            result['server'] = dict(server_after, cpu_seconds=round(server_after['cpu_seconds'] - server_before['cpu_seconds'], 3))
+
+    if process is not None:
+        process.stdin.write('!stop\n')
+        process.stdin.flush()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+    output = json.dumps(result, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
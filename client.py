@@ -1,7 +1,13 @@
+import os
+import random
 import socket
+import tempfile
 import threading
-import pygame
 import time
+import pygame
+from scrollback import Scrollback
+from protocol import FrameDecoder, BinaryDecoder, encode_binary, PROTOCOL_VERSION, SPLITTER_LENGTH
+from line_buffer import LineBuffer
 
 
 # message format: type:content,content:end
@@ -18,6 +24,9 @@ class Client:
 
         self.screen = pygame.display.set_mode(self.screen_dimensions)
         self.clock = pygame.time.Clock()
+        # the main loop sleeps on the event queue, the network thread wakes it with this event
+        self.network_event = pygame.event.custom_type()
+        pygame.event.set_blocked(pygame.MOUSEMOTION)
         self.text_font = pygame.font.Font('data/font.ttf', 15)
 
         self.hostname = socket.gethostname()
@@ -25,14 +34,7 @@ class Client:
 
         pygame.display.set_caption(f'CLIENT: {self.local_ip}')
 
-        self.line_height = self.text_font.get_linesize()
-        self.text_max_height = self.screen_height - 35
-        self.max_lines = self.text_max_height // self.line_height
-        self.last_line_amount = 0
-        self.text_offset = 0
-        self.user_scrolling = False
-
-        self.screen_text = [
+        self.banner = [
             r'   ________  _____  ______________________',
             r'  / ____/ / / /   |/ ___ / ___ / ____/ __ \ ',
             r' / /   / /_/ / /| | / /   / / / __/ / /_/ /  1. enter the servers IP',
@@ -40,6 +42,10 @@ class Client:
             r'\____/_/ /_/_/  |_/_/   /_/ /_____/_/ |_|',
             ''
                 ]
+        self.scrollback_capacity = 5000
+        self.screen_text = LineBuffer(self.scrollback_capacity, os.path.join(tempfile.gettempdir(), f'chatter_client_{os.getpid()}.txt'))
+        for line in self.banner:
+            self.screen_text.append(line)
         self.input_message = 'enter host IP>>> '
         self.input_text = ''
         self.input_history = []
@@ -47,11 +53,37 @@ class Client:
 
         self.text_type = 'text'
         self.announcement_type = 'announcement'
+        self.room_type = 'room'
+        self.hello_type = 'hello'
+        self.seq_type = 'seq'
+        self.joined_type = 'joined'
+        self.resume_type = 'resume'
+        self.ping_type = 'ping'
+        self.pong_type = 'pong'
+        self.binary_type = 'binary'
+        self.presence_type = 'presence'
+        self.roster_type = 'roster'
+        self.rooms_type = 'rooms'
+        self.capabilities = []
+        # frames to the server are binary once the switch was requested
+        self.binary = False
         self.end_command = 'end'
         self.message_splitter = ':'
 
-        self.text_render = self.render_text()
+        self.text_max_height = self.screen_height - 35
+        # names online, kept up to date by roster and presence frames and shown in a panel right of the chat
+        self.roster = set()
+        self.roster_version = 0
+        self.roster_width = 160
+        self.scrollback = Scrollback(self.text_font, self.screen_text, self.screen_width - self.roster_width, self.text_max_height)
         self.input_render = self.text_font.render(self.input_message + self.input_text, True, (174, 174, 174))
+        self.input_rect = pygame.Rect(5, self.screen_height - self.input_render.get_height() - 20, self.screen_width - 10, self.input_render.get_height() + 20)
+
+        # what is on screen, compared against the current state to decide what to redraw
+        self.drawn_lines = None
+        self.drawn_offset = None
+        self.drawn_input = None
+        self.drawn_roster = None
 
         # network
         self.is_connected = False
@@ -60,34 +92,90 @@ class Client:
         self.buffersize = 4096
         self.address = None
 
+        # the name the server accepted and the sequence number of the last broadcast shown, to resume after a drop
+        self.name = None
+        self.last_seq = None
+        self.pending_seq = None
+        # content of the last rooms frame, sent back on resume to get the same rooms
+        self.rooms = ''
+        # from the joined frame, a resume without it can not take over a session the server still holds
+        self.resume_token = ''
+        # reconnect delays are drawn from 0 to min(cap, base * 2 ** attempt) so clients of a restarted server spread out
+        self.reconnect_base = 0.5
+        self.reconnect_cap = 30
+        self.reconnect_attempt = 0
+        # bumped by a disconnect so an old reconnect loop stops
+        self.connection_generation = 0
+
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+    # blocks until something happens, then redraws the whole window if the text or the view changed
+    # and only the input line if just that changed, at most fps times a second
     def run(self):
+        redraw = True
         while self.running:
+            events = [pygame.event.wait()] + pygame.event.get()
+            for event in events:
+                if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED, pygame.WINDOWRESTORED):
+                    redraw = True
+
+            self.handle_input(events)
+
+            self.scrollback.update()
+            if redraw or self.drawn_lines != len(self.screen_text) or self.drawn_offset != self.scrollback.bottom_offset or self.drawn_roster != self.roster_version:
+                self.draw_screen()
+                pygame.display.update()
+                redraw = False
+            elif self.drawn_input != self.input_message + self.input_text:
+                self.draw_input()
+                pygame.display.update(self.input_rect)
+            else:
+                continue
             self.clock.tick(self.fps)
-            self.screen.fill((12, 12, 12))
 
-            self.handle_input()
-
-            if len(self.screen_text) != self.last_line_amount:
-                self.last_line_amount = len(self.screen_text)
-                self.text_render = self.render_text()
-                if self.text_render.get_height() > self.text_max_height and not self.user_scrolling:
-                    self.text_offset = self.text_max_height - self.text_render.get_height()
-
-            self.screen.blit(self.text_render, (0, self.text_offset))
-
-            pygame.draw.rect(self.screen, (12, 12, 12), (5, self.screen_height - self.input_render.get_height() - 20, self.screen_width - 10, self.input_render.get_height() + 20))
-            self.screen.blit(self.input_render, (10, self.screen_height - self.input_render.get_height() - 10))
-            pygame.draw.rect(self.screen, (174, 174, 174), (5, self.screen_height - self.input_render.get_height() - 15, self.screen_width - 10, self.input_render.get_height() + 10), width=1, border_radius=3)
-
-            pygame.display.update()
-
-        self.send_message(self.build_message(self.text_type, '{quit}'))
+        self.send_message(self.text_type, '{quit}')
         self.client.close()
+        self.screen_text.close(delete=True)
+
+    def draw_screen(self):
+        self.screen.fill((12, 12, 12))
+        self.scrollback.draw(self.screen)
+        self.drawn_lines = self.scrollback.line_count
+        self.drawn_offset = self.scrollback.bottom_offset
+        self.draw_roster()
+        self.draw_input()
+
+    def draw_roster(self):
+        left = self.screen_width - self.roster_width
+        pygame.draw.rect(self.screen, (12, 12, 12), (left, 0, self.roster_width, self.text_max_height))
+        pygame.draw.line(self.screen, (174, 174, 174), (left, 10), (left, self.text_max_height - 10))
+
+        names = sorted(self.roster, key=str.lower)
+        line_height = self.text_font.get_linesize()
+        rows = (self.text_max_height - 20) // line_height - 1
+        self.screen.blit(self.scrollback.render_line(f'online: {len(names)}'), (left + 10, 10))
+        if len(names) > rows:
+            names = names[:rows - 1] + [f'+{len(names) - rows + 1} more']
+        for i, name in enumerate(names):
+            self.screen.blit(self.scrollback.render_line(name), (left + 10, 10 + (i + 1) * line_height))
+        self.drawn_roster = self.roster_version
+
+    def draw_input(self):
+        pygame.draw.rect(self.screen, (12, 12, 12), self.input_rect)
+        self.screen.blit(self.input_render, (10, self.screen_height - self.input_render.get_height() - 10))
+        pygame.draw.rect(self.screen, (174, 174, 174), (5, self.screen_height - self.input_render.get_height() - 15, self.screen_width - 10, self.input_render.get_height() + 10), width=1, border_radius=3)
+        self.drawn_input = self.input_message + self.input_text
+
+    # called from the network thread after new lines or state, pygame's event queue is thread safe
+    def wake(self):
+        try:
+            pygame.event.post(pygame.event.Event(self.network_event))
+        except pygame.error:
+            # the window is already gone
+            pass
 
-    def handle_input(self):
-        for event in pygame.event.get():
+    def handle_input(self, events):
+        for event in events:
             if event.type == pygame.QUIT:
                 self.running = False
 
@@ -96,7 +184,7 @@ class Client:
                     self.input_text = self.input_text[:-1]
                 elif event.key == pygame.K_RETURN:
                     if self.is_connected and self.input_text != '':
-                        self.send_message(self.build_message(self.text_type, self.input_text))
+                        self.send_message(self.text_type, self.input_text)
                         if self.input_text == '{quit}':
                             self.disconnect_from_server()
                     else:
@@ -109,9 +197,11 @@ class Client:
                                 self.port = int(self.input_text)
                                 self.input_message = '>>> '
                                 self.screen_text.append(f'host port is set to: {self.port}')
-                                threading.Thread(target=self.connect_to_server).start()
+                                threading.Thread(target=self.connect_to_server, daemon=True).start()
                             else:
                                 self.screen_text.append('ERROR: invalid port format!')
+                        elif self.input_text != '':
+                            self.screen_text.append('ERROR: not connected, waiting to reconnect')
                     self.input_history.append(self.input_text)
                     self.input_text = ''
                 elif event.key == pygame.K_UP:
@@ -140,84 +230,193 @@ class Client:
                 self.input_render = self.text_font.render(self.input_message + self.input_text, True, (174, 174, 174))
 
             if event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 4:
-                    self.text_offset += 15
-                    self.user_scrolling = True
-                    if self.text_offset > 0:
-                        self.text_offset = 0
-                elif event.button == 5:
-                    self.text_offset -= 15
-                    self.user_scrolling = True
-                    if self.text_offset < -self.text_render.get_height() + self.line_height + 10:
-                        self.text_offset = -self.text_render.get_height() + self.line_height + 10
-                        self.user_scrolling = False
+                self.scrollback.handle_event(event)
 
+    # connects and receives until the connection drops, then reconnects after a jittered backoff
+    # until the user disconnects or quits
     def connect_to_server(self):
-        try:
-            self.address = (self.host, self.port)
-            self.client.connect(self.address)
-            receive_thread = threading.Thread(target=self.get_message)
-            receive_thread.start()
-            self.is_connected = True
-        except OSError:
-            self.screen_text.append('ERROR: invalid host information!')
-            self.input_message = 'enter host IP>>> '
-            self.host = None
-            self.port = None
-            self.is_connected = False
-            self.input_render = self.text_font.render(self.input_message + self.input_text, True, (174, 174, 174))
+        generation = self.connection_generation
+        self.address = (self.host, self.port)
+        self.reconnect_attempt = 0
+        connected_before = False
+        while self.running and generation == self.connection_generation:
+            try:
+                self.client.connect(self.address)
+            except OSError:
+                if not connected_before:
+                    self.client.close()
+                    self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    self.screen_text.append('ERROR: invalid host information!')
+                    self.input_message = 'enter host IP>>> '
+                    self.host = None
+                    self.port = None
+                    self.is_connected = False
+                    self.input_render = self.text_font.render(self.input_message + self.input_text, True, (174, 174, 174))
+                    self.wake()
+                    return
+            else:
+                connected_before = True
+                self.is_connected = True
+                self.get_message()
+                self.is_connected = False
+
+            if not self.running or generation != self.connection_generation:
+                return
+            delay = random.uniform(0, min(self.reconnect_cap, self.reconnect_base * 2 ** self.reconnect_attempt))
+            self.reconnect_attempt += 1
+            self.screen_text.append(f'ERROR: connection lost, reconnecting in {delay:.1f} seconds')
+            self.wake()
+            self.client.close()
+            self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            time.sleep(delay)
 
     def disconnect_from_server(self):
+        self.connection_generation += 1
         self.client.close()
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.input_message = 'enter host IP>>> '
         self.host = None
         self.port = None
+        self.name = None
+        self.last_seq = None
+        self.rooms = ''
+        self.resume_token = ''
+        self.roster = set()
+        self.roster_version += 1
         self.is_connected = False
         self.input_render = self.text_font.render(self.input_message + self.input_text, True, (174, 174, 174))
-        self.screen_text = self.screen_text[:6]
+        self.screen_text.truncate(len(self.banner))
 
     def get_message(self):
-        self.message_splitter = self.client.recv(self.buffersize).decode("utf8")
+        # the splitter has a fixed length, whatever follows it in the same read is already framed
+        data = b''
+        while len(data) < SPLITTER_LENGTH:
+            try:
+                received = self.client.recv(self.buffersize)
+            except OSError:
+                return
+            if not received:
+                return
+            data += received
+        self.message_splitter = data[:SPLITTER_LENGTH].decode('utf8')
+        data = data[SPLITTER_LENGTH:]
+        self.pending_seq = None
+
+        self.binary = False
+        self.roster = set()
+        self.roster_version += 1
+        decoder = FrameDecoder(self.message_splitter, self.end_command, stop_type=self.binary_type)
         while True:
             try:
-                raw_message = self.client.recv(self.buffersize).decode("utf8")
-
-                message_list = raw_message.split(self.message_splitter)
-
-                messages = []
-                previous_end = 0
-                for i, piece in enumerate(message_list):
-                    if piece == self.end_command and (i + 1) % 3 == 0:
-                        messages.append(message_list[previous_end:i + 1])
-                        previous_end = i + 1
-
-                for single_message in messages:
-                    if single_message[0] == self.text_type:
-                        self.screen_text.append(single_message[1])
-                    elif single_message[0] == self.announcement_type:
-                        self.screen_text.append(f'HOST {self.host}:{self.port}>>> ' + single_message[1])
-
-            except OSError:  # client disconnected
+                if isinstance(decoder, BinaryDecoder):
+                    frames = [(message_type, str(payload, 'utf8', 'replace'), seq) for message_type, seq, payload in decoder.frames(data)]
+                else:
+                    frames = [(message_type, content, 0) for message_type, content in decoder.feed(data)]
+                data = b''
+
+                for message_type, content, seq in frames:
+                    if seq:
+                        self.pending_seq = seq
+
+                    if message_type == self.hello_type:
+                        version, capabilities, prompt = content.split(' ', 2)
+                        if int(version) != PROTOCOL_VERSION:
+                            self.screen_text.append(f'ERROR: the server speaks protocol version {version}, this client speaks {PROTOCOL_VERSION}')
+                            self.client.close()
+                            self.wake()
+                            return
+                        self.capabilities = capabilities.split(',')
+                        if 'binary' in self.capabilities:
+                            # everything sent after this frame is binary, the server answers with a binary frame of its own
+                            self.send_message(self.binary_type, 'on')
+                            self.binary = True
+                        if 'presence' in self.capabilities:
+                            self.send_message(self.presence_type, 'on')
+                        if 'ping' in self.capabilities:
+                            # tells the server this client answers its pings
+                            self.send_message(self.ping_type, 'on')
+                        if self.name is not None and self.last_seq is not None and 'resume' in self.capabilities:
+                            # a reconnect, ask for what was missed under the old name
+                            self.send_message(self.resume_type, f'{self.last_seq} {self.name} {self.resume_token} {self.rooms}'.rstrip())
+                        else:
+                            self.screen_text.append(f'HOST {self.host}:{self.port}>>> ' + prompt)
+                        continue
+                    elif message_type == self.ping_type:
+                        # the server drops clients that stay silent, answering keeps an idle client connected
+                        self.send_message(self.pong_type, content)
+                        continue
+                    elif message_type == self.pong_type:
+                        continue
+                    elif message_type == self.binary_type:
+                        # the text decoder stopped at this frame, the rest of the stream is binary
+                        data = decoder.remainder()
+                        decoder = BinaryDecoder()
+                        break
+                    elif message_type == self.rooms_type:
+                        self.rooms = content
+                        continue
+                    elif message_type == self.roster_type:
+                        self.roster = set(content.split('\n')) if content else set()
+                        self.roster_version += 1
+                        continue
+                    elif message_type == self.presence_type:
+                        # '+name' and '-name' lines, applying one twice changes nothing
+                        # a new set is swapped in so the main thread never draws one that is being changed
+                        roster = set(self.roster)
+                        for change in content.split('\n'):
+                            if change[:1] == '+':
+                                roster.add(change[1:])
+                            elif change[:1] == '-':
+                                roster.discard(change[1:])
+                        self.roster = roster
+                        self.roster_version += 1
+                        continue
+                    elif message_type == self.seq_type:
+                        self.pending_seq = int(content)
+                        continue
+                    elif message_type == self.joined_type:
+                        self.name, _, self.resume_token = content.partition(' ')
+                        self.reconnect_attempt = 0
+                        continue
+                    elif message_type == self.text_type:
+                        self.screen_text.append(content)
+                    elif message_type == self.announcement_type:
+                        self.screen_text.append(f'HOST {self.host}:{self.port}>>> ' + content)
+                    elif message_type == self.room_type:
+                        room, line = content.split(' ', 1)
+                        self.screen_text.append(f'[{room}] {line}')
+
+                    # the sequence number only counts as seen once its message is shown
+                    if self.pending_seq is not None:
+                        self.last_seq = self.pending_seq
+                        self.pending_seq = None
+
+                if data:
+                    continue
+                # one wake up per read, however many frames it held
+                self.wake()
+                data = self.client.recv(self.buffersize)
+                if not data:
+                    break
+            except (OSError, ValueError):  # client disconnected
                 break
 
-    def send_message(self, message):
-        self.client.send(bytes(message, "utf8"))
+    def send_message(self, type, content):
+        if self.binary:
+            data = encode_binary(type, content.encode('utf8'))
+        else:
+            data = bytes(self.build_message(type, content), 'utf8')
+        try:
+            self.client.sendall(data)
+        except OSError:
+            # the receive side notices the drop and reconnects
+            pass
 
     def build_message(self, type, content):
-        if type == self.text_type:
+        if type in (self.text_type, self.resume_type, self.ping_type, self.pong_type, self.binary_type, self.presence_type):
             message = f'{type}{self.message_splitter}{content}{self.message_splitter}{self.end_command}{self.message_splitter}'
             return message
 
-    def render_text(self):
-        height = len(self.screen_text) * self.line_height + 20
-        new_surface = pygame.Surface((self.screen_width, height))
-        new_surface.fill((12, 12, 12))
-        for i, line in enumerate(self.screen_text):
-            new_surface.blit(self.text_font.render(line, True, (174, 174, 174)), (10, 10 + i * self.line_height))
-
-        return new_surface
-
 
 if __name__ == '__main__':
     Client().run()
@@ -0,0 +1,154 @@
+import json
+import os
+import socket
+import threading
+import time
+
+
+# one json object per line on a unix socket, every line a worker publishes is relayed to all other workers
+class BusConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.worker = None
+        self.names = set()
+        self.lock = threading.Lock()
+
+    def send(self, line):
+        with self.lock:
+            try:
+                self.sock.sendall(line)
+            except OSError:
+                pass
+
+
+# runs in the supervisor process and remembers who is online and the admin changes
+# so a worker that (re)connects starts from the same state as the others
+class Hub:
+    def __init__(self, path):
+        self.path = path
+        self.connections = []
+        self.admins = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+
+    def start(self):
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+
+    def stop(self):
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        with self.lock:
+            for connection in self.connections:
+                connection.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def accept_workers(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            connection = BusConnection(sock)
+            with self.lock:
+                state = [{'event': 'join', 'name': name} for other in self.connections for name in other.names]
+                state += [{'event': 'admin', 'ip': ip, 'level': level} for ip, level in self.admins.items()]
+                self.connections.append(connection)
+                if state:
+                    connection.send(''.join(json.dumps(event) + '\n' for event in state).encode('utf8'))
+            threading.Thread(target=self.relay, args=(connection,), daemon=True).start()
+
+    def relay(self, connection):
+        try:
+            for line in connection.sock.makefile('rb'):
+                event = json.loads(line)
+                with self.lock:
+                    if event['event'] == 'hello':
+                        connection.worker = event['worker']
+                        continue
+                    elif event['event'] == 'join':
+                        connection.names.add(event['name'])
+                    elif event['event'] == 'leave':
+                        connection.names.discard(event['name'])
+                    elif event['event'] == 'admin':
+                        self.admins[event['ip']] = event['level']
+                    others = [other for other in self.connections if other is not connection]
+                for other in others:
+                    other.send(line)
+        except (OSError, ValueError):
+            pass
+
+        # a worker that went away takes its users with it
+        with self.lock:
+            if connection not in self.connections:
+                return
+            self.connections.remove(connection)
+            others = list(self.connections)
+        lines = ''.join(json.dumps({'event': 'leave', 'name': name}) + '\n' for name in connection.names).encode('utf8')
+        if lines:
+            for other in others:
+                other.send(lines)
+        connection.sock.close()
+
+    def publish(self, event, worker=None):
+        line = (json.dumps(event) + '\n').encode('utf8')
+        with self.lock:
+            targets = [connection for connection in self.connections if worker is None or connection.worker == worker]
+        for connection in targets:
+            connection.send(line)
+
+
+# the worker side of the bus, events from other workers are handed to the callback on the reader thread
+class BusClient:
+    def __init__(self, path, worker, callback):
+        self.path = path
+        self.worker = worker
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def start(self):
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+                break
+            except OSError:
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.publish({'event': 'hello', 'worker': self.worker})
+        threading.Thread(target=self.read_events, daemon=True).start()
+
+    def stop(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+    def read_events(self):
+        try:
+            for line in self.sock.makefile('rb'):
+                self.callback(json.loads(line))
+        except (OSError, ValueError):
+            pass
+
+    def publish(self, event):
+        line = (json.dumps(event) + '\n').encode('utf8')
+        with self.lock:
+            try:
+                self.sock.sendall(line)
+            except OSError:
+                pass
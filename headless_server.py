@@ -0,0 +1,87 @@
+import json
+import multiprocessing
+import sys
+import threading
+from server_core import ServerCore
+from cluster import Hub
+
+
+# runs the server without pygame: logs go to stdout unless the core writes them to a log file, commands come from stdin
+class HeadlessServer:
+    def __init__(self, core=None):
+        self.core = core if core is not None else ServerCore()
+
+        if not self.core.config['log_file']:
+            self.core.log_listeners.append(self.write_line)
+
+    def run(self):
+        input_thread = threading.Thread(target=self.read_commands, daemon=True)
+        input_thread.start()
+
+        self.core.start()
+        try:
+            self.core.stopped.wait()
+        except KeyboardInterrupt:
+            self.core.request_stop()
+        self.core.shutdown()
+
+    def read_commands(self):
+        for line in sys.stdin:
+            line = line.strip()
+            if line != '':
+                self.core.submit_command(line)
+
+    def write_line(self, line):
+        print(line, flush=True)
+
+
+def run_worker(config_path, worker):
+    HeadlessServer(ServerCore(config_path, worker)).run()
+
+
+# starts one worker process per configured worker and relays events between them over the hub,
+# console commands go to the first worker and stopping any worker stops all of them
+class Supervisor:
+    def __init__(self, config_path, workers):
+        self.config_path = config_path
+        self.workers = workers
+        with open(config_path, 'r') as f:
+            self.config = json.load(f)
+        self.hub = Hub(self.config['bus_path'])
+        self.processes = []
+
+    def run(self):
+        self.hub.start()
+        context = multiprocessing.get_context('spawn')
+        for worker in range(self.workers):
+            process = context.Process(target=run_worker, args=(self.config_path, worker))
+            process.start()
+            self.processes.append(process)
+
+        input_thread = threading.Thread(target=self.read_commands, daemon=True)
+        input_thread.start()
+
+        try:
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            self.hub.publish({'event': 'stop'})
+            for process in self.processes:
+                process.join()
+        self.hub.stop()
+
+    def read_commands(self):
+        for line in sys.stdin:
+            line = line.strip()
+            if line != '':
+                self.hub.publish({'event': 'command', 'command': line}, worker=0)
+
+
+if __name__ == '__main__':
+    config_path = sys.argv[1] if len(sys.argv) > 1 else 'data/config.json'
+    with open(config_path, 'r') as f:
+        workers = json.load(f)['workers']
+    if workers > 1:
+        Supervisor(config_path, workers).run()
+    else:
+        HeadlessServer(ServerCore(config_path)).run()
@@ -0,0 +1,175 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+# record: sequence number, unix time, message type, payload length, then the utf8 payload
+RECORD_HEADER = struct.Struct('<QdBI')
+INDEX_ENTRY = struct.Struct('<QQ')
+
+
+class Segment:
+    def __init__(self, path, base_seq):
+        self.path = path
+        self.index_path = path[:-len('.log')] + '.idx'
+        self.base_seq = base_seq
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+        # sparse index: (sequence number, file offset) for every index_interval-th record
+        self.index_seqs = []
+        self.index_offsets = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            for seq, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                self.index_seqs.append(seq)
+                self.index_offsets.append(offset)
+
+        self.map = None
+        self.mapped_size = 0
+
+    def view(self):
+        if self.size == 0:
+            return memoryview(b'')
+        if self.map is None or self.mapped_size != self.size:
+            # an older map may still back views handed out earlier, it is released when the last one goes away
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapped_size = self.size
+        return memoryview(self.map)
+
+    def records(self, after_seq):
+        view = self.view()
+        position = 0
+        i = bisect.bisect_right(self.index_seqs, after_seq + 1) - 1
+        if i >= 0:
+            position = self.index_offsets[i]
+
+        while position + RECORD_HEADER.size <= self.size:
+            seq, timestamp, message_type, length = RECORD_HEADER.unpack_from(view, position)
+            start = position + RECORD_HEADER.size
+            if start + length > self.size:
+                break
+            if seq > after_seq:
+                yield seq, timestamp, message_type, view[start:start + length]
+            position = start + length
+
+    # finds the last complete record and cuts off a record left half written by a crash
+    # index entries are written after their record, one pointing past the last complete record is dropped
+    def recover(self):
+        while True:
+            last = None
+            end = self.index_offsets[-1] if self.index_offsets else 0
+            for seq, _, _, payload in self.records(self.index_seqs[-1] - 1 if self.index_seqs else -1):
+                last = seq
+                end += RECORD_HEADER.size + len(payload)
+            if last is not None or not self.index_seqs:
+                break
+            self.index_seqs.pop()
+            self.index_offsets.pop()
+
+        if end < self.size:
+            self.map = None
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+            self.size = end
+        if os.path.exists(self.index_path) and os.path.getsize(self.index_path) != len(self.index_seqs) * INDEX_ENTRY.size:
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(len(self.index_seqs) * INDEX_ENTRY.size)
+        return last
+
+    # the map itself is unmapped once no view into it is left
+    def close(self):
+        self.map = None
+
+
+# append only chat history split into segment files named after their first sequence number
+class History:
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, index_interval=64, max_segments=64):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = []
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith('.log'):
+                self.segments.append(Segment(os.path.join(directory, file_name), int(file_name[:-len('.log')])))
+
+        self.next_seq = 1
+        self.records_in_segment = 0
+        if self.segments:
+            last = self.segments[-1].recover()
+            self.next_seq = last + 1 if last is not None else self.segments[-1].base_seq
+            self.records_in_segment = self.next_seq - self.segments[-1].base_seq
+        else:
+            self.new_segment()
+
+        self.writer = open(self.segments[-1].path, 'ab', buffering=0)
+        self.index_writer = open(self.segments[-1].index_path, 'ab', buffering=0)
+
+    def new_segment(self):
+        path = os.path.join(self.directory, f'{self.next_seq:020d}.log')
+        open(path, 'ab').close()
+        self.segments.append(Segment(path, self.next_seq))
+        self.records_in_segment = 0
+
+        while len(self.segments) > self.max_segments:
+            old = self.segments.pop(0)
+            old.close()
+            os.remove(old.path)
+            if os.path.exists(old.index_path):
+                os.remove(old.index_path)
+
+    def append(self, message_type, content):
+        payload = content.encode('utf8')
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.size >= self.segment_bytes:
+                self.writer.close()
+                self.index_writer.close()
+                self.new_segment()
+                segment = self.segments[-1]
+                self.writer = open(segment.path, 'ab', buffering=0)
+                self.index_writer = open(segment.index_path, 'ab', buffering=0)
+
+            seq = self.next_seq
+            offset = segment.size
+            self.writer.write(RECORD_HEADER.pack(seq, time.time(), message_type, len(payload)) + payload)
+            segment.size += RECORD_HEADER.size + len(payload)
+            # the record goes first, so a crash never leaves an index entry without its record
+            if self.records_in_segment % self.index_interval == 0:
+                self.index_writer.write(INDEX_ENTRY.pack(seq, offset))
+                segment.index_seqs.append(seq)
+                segment.index_offsets.append(offset)
+
+            self.records_in_segment += 1
+            self.next_seq += 1
+            return seq
+
+    # records with a sequence number above after_seq, payloads are memoryviews into the mapped segments
+    def read_since(self, after_seq, limit=None):
+        with self.lock:
+            result = []
+            first = max(0, bisect.bisect_right([segment.base_seq for segment in self.segments], after_seq + 1) - 1)
+            for segment in self.segments[first:]:
+                for record in segment.records(after_seq):
+                    result.append(record)
+                    if limit is not None and len(result) >= limit:
+                        return result
+            return result
+
+    def tail(self, count):
+        return self.read_since(max(0, self.next_seq - 1 - count))
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+            self.index_writer.close()
+            for segment in self.segments:
+                segment.close()
@@ -0,0 +1,116 @@
+import os
+import struct
+import threading
+
+
+# keeps the newest lines in a fixed ring and spills older ones to disk, so memory stays flat for long sessions
+# spill file: utf8 lines separated by newlines, index file: one 8 byte offset per spilled line
+class LineBuffer:
+    def __init__(self, capacity, spill_path, block_size=64):
+        self.capacity = capacity
+        self.ring = [None] * capacity
+        self.start = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.spill_path = spill_path
+        self.spilled = 0
+        self.spill_end = 0
+        self.spill_writer = open(spill_path, 'wb')
+        self.index_writer = open(spill_path + '.idx', 'wb')
+        self.spill_reader = open(spill_path, 'rb', buffering=0)
+        self.index_reader = open(spill_path + '.idx', 'rb', buffering=0)
+        self.unflushed = False
+
+        # spilled lines are read back one block at a time when the view scrolls past the ring
+        self.block_size = block_size
+        self.block_start = 0
+        self.block = []
+
+    def __len__(self):
+        return self.spilled + self.count
+
+    def __getitem__(self, index):
+        with self.lock:
+            if index < 0:
+                index += self.spilled + self.count
+            if not 0 <= index < self.spilled + self.count:
+                raise IndexError('line index out of range')
+
+            if index >= self.spilled:
+                return self.ring[(self.start + index - self.spilled) % self.capacity]
+
+            if not self.block_start <= index < self.block_start + len(self.block):
+                self.load_block(index - index % self.block_size)
+            return self.block[index - self.block_start]
+
+    def append(self, line):
+        with self.lock:
+            if self.count < self.capacity:
+                self.ring[(self.start + self.count) % self.capacity] = line
+                self.count += 1
+            else:
+                self.spill(self.ring[self.start])
+                self.ring[self.start] = line
+                self.start = (self.start + 1) % self.capacity
+
+    def spill(self, line):
+        data = line.encode('utf8') + b'\n'
+        self.index_writer.write(struct.pack('<Q', self.spill_end))
+        self.spill_writer.write(data)
+        self.spill_end += len(data)
+        self.spilled += 1
+        self.unflushed = True
+
+    def flush(self):
+        if self.unflushed:
+            self.spill_writer.flush()
+            self.index_writer.flush()
+            self.unflushed = False
+
+    def read_offset(self, index):
+        if index == self.spilled:
+            return self.spill_end
+        self.index_reader.seek(index * 8)
+        return struct.unpack('<Q', self.index_reader.read(8))[0]
+
+    def load_block(self, start):
+        self.flush()
+        end = min(start + self.block_size, self.spilled)
+
+        first = self.read_offset(start)
+        self.spill_reader.seek(first)
+        data = self.spill_reader.read(self.read_offset(end) - first)
+
+        self.block = data.decode('utf8').split('\n')[:end - start]
+        self.block_start = start
+
+    def truncate(self, length):
+        with self.lock:
+            if length >= self.spilled + self.count:
+                return
+
+            if length >= self.spilled:
+                self.count = length - self.spilled
+                return
+
+            self.flush()
+            self.spill_end = self.read_offset(length)
+            self.spilled = length
+            self.spill_writer.truncate(self.spill_end)
+            self.spill_writer.seek(self.spill_end)
+            self.index_writer.truncate(length * 8)
+            self.index_writer.seek(length * 8)
+            self.count = 0
+            self.start = 0
+            self.block = []
+
+    def close(self, delete=False):
+        with self.lock:
+            self.spill_writer.close()
+            self.index_writer.close()
+            self.spill_reader.close()
+            self.index_reader.close()
+            if delete:
+                os.remove(self.spill_path)
+                os.remove(self.spill_path + '.idx')
@@ -0,0 +1,105 @@
+import os
+import queue
+import threading
+import time
+
+
+# producers only put a (time, event, text) tuple on a queue, a writer thread formats the lines,
+# hands them to the consumers and appends them to a log file that rotates by size and age
+class LogPipeline:
+    def __init__(self, path='', max_bytes=10 * 1024 * 1024, max_age=86400, backups=5, consumers=()):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.consumers = list(consumers)
+
+        self.records = queue.SimpleQueue()
+        self.stamp_second = None
+        self.stamp = ''
+
+        self.file = None
+        self.file_size = 0
+        self.file_opened = 0.0
+        if path:
+            self.open_file()
+
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def push(self, event, text):
+        self.records.put((time.time(), event, text))
+
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # the clock only moves once a second, so is the formatted time
+    def timestamp(self, now):
+        second = int(now)
+        if second != self.stamp_second:
+            self.stamp_second = second
+            self.stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        return self.stamp
+
+    def format(self, record):
+        now, event, text = record
+        stamp = self.timestamp(now)
+        if isinstance(text, str):
+            return [f'[{stamp}] {event}{text}']
+        padding = ' ' * (len(stamp) + 3 + len(event))
+        return [f'[{stamp}] {event}{line}' if i == 0 else padding + line for i, line in enumerate(text)]
+
+    def write_loop(self):
+        running = True
+        while running:
+            # block for the first record, then take whatever else is already waiting
+            batch = [self.records.get()]
+            try:
+                while len(batch) < 1024:
+                    batch.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = []
+            for record in batch:
+                if record is None:
+                    running = False
+                    break
+                lines.extend(self.format(record))
+
+            for line in lines:
+                for consumer in self.consumers:
+                    consumer(line)
+            if self.file is not None and lines:
+                self.write_lines(lines)
+
+    def write_lines(self, lines):
+        data = '\n'.join(lines) + '\n'
+        size = len(data.encode('utf8'))
+        if self.file_size and (self.file_size + size > self.max_bytes or time.time() - self.file_opened > self.max_age):
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.file_size += size
+
+    def open_file(self):
+        self.file = open(self.path, 'a', encoding='utf8')
+        self.file_size = self.file.tell()
+        self.file_opened = time.time()
+
+    # log -> log.1 -> log.2 ... and the oldest one past backups is removed
+    def rotate(self):
+        self.file.close()
+        if os.path.isfile(self.path):
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            if self.backups > 0:
+                os.replace(self.path, f'{self.path}.1')
+            else:
+                os.remove(self.path)
+        self.open_file()
@@ -0,0 +1,141 @@
+import bisect
+import http.server
+import threading
+import time
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.rate = 0.0
+        self.last_value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self, name, description, function):
+        self.name = name
+        self.description = description
+        self.function = function
+
+
+# fixed buckets so observing is one bisect and two additions
+class Histogram:
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+def exponential_buckets(start, factor, count):
+    return [start * factor ** i for i in range(count)]
+
+
+class Metrics:
+    def __init__(self, prefix='chatter'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.last_sample = time.monotonic()
+
+    def counter(self, name, description):
+        self.counters[name] = Counter(name, description)
+        return self.counters[name]
+
+    def gauge(self, name, description, function):
+        self.gauges[name] = Gauge(name, description, function)
+        return self.gauges[name]
+
+    def histogram(self, name, description, buckets):
+        self.histograms[name] = Histogram(name, description, buckets)
+        return self.histograms[name]
+
+    # called about once a second to turn counters into per second rates
+    def sample(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_sample, 1e-9)
+        self.last_sample = now
+        for counter in self.counters.values():
+            value = counter.value
+            counter.rate = (value - counter.last_value) / elapsed
+            counter.last_value = value
+
+    def render_prometheus(self):
+        lines = []
+        for counter in self.counters.values():
+            name = f'{self.prefix}_{counter.name}_total'
+            lines.append(f'# HELP {name} {counter.description}')
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {counter.value}')
+        for gauge in self.gauges.values():
+            name = f'{self.prefix}_{gauge.name}'
+            lines.append(f'# HELP {name} {gauge.description}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {gauge.function()}')
+        for histogram in self.histograms.values():
+            name = f'{self.prefix}_{histogram.name}'
+            lines.append(f'# HELP {name} {histogram.description}')
+            lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum {histogram.sum}')
+            lines.append(f'{name}_count {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+# serves render_prometheus as plain text on a local port
+class MetricsEndpoint:
+    def __init__(self, metrics, host, port):
+        metrics_source = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics_source.render_prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = http.server.HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
@@ -0,0 +1,454 @@
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+
+
+# buffers handed to one sendmsg call, well below the usual IOV_MAX of 1024
+MAX_BUFFERS = 256
+# how long a stopping server keeps flushing queued messages, shared by all connections
+SHUTDOWN_DRAIN_SECONDS = 1
+
+
+class Connection:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.name = None
+        self.decoder = None
+        # 'hello' until the client registered a name, then 'joined'
+        self.state = 'hello'
+        # rooms the client is subscribed to and the one its chat lines go to
+        self.rooms = set()
+        self.room = None
+        # set once the client switched to binary framing
+        self.binary = False
+        # set once the client asked for roster and presence frames
+        self.presence = False
+        # set once the client sent a ping, only then it is pinged and dropped for staying silent
+        self.heartbeat = False
+        # handed to the client when its name is accepted, a resume has to show it to take over the session
+        self.resume_token = ''
+        self.closed = False
+        self.closing = False
+        self.connected_at = time.monotonic()
+        # monotonic times of the last read from the client and the last ping sent to it
+        self.last_received = self.connected_at
+        self.pinged_at = 0.0
+        # while set, nothing more is read from the socket until this monotonic time
+        self.paused_until = 0.0
+        self.limited = 0
+        # frames read but not handled yet, waiting for the message buckets to refill
+        self.held = collections.deque()
+
+        # encoded messages waiting to be written, the first one may be partially sent
+        self.outbound = collections.deque()
+        self.outbound_bytes = 0
+        self.head_offset = 0
+        self.dropped_messages = 0
+        self.writing = False
+        self.condition = threading.Condition()
+
+
+# outbound queue bookkeeping and slow consumer policy shared by both engines
+class Engine:
+    def __init__(self, server, listener):
+        self.server = server
+        self.listener = listener
+        self.connections = set()
+
+        self.dropped_messages = 0
+        self.slow_consumer_disconnects = 0
+
+    def enqueue(self, connection, data):
+        connection.outbound.append(data)
+        connection.outbound_bytes += len(data)
+        if connection.outbound_bytes <= self.server.max_queue_bytes:
+            return True
+
+        if self.server.slow_consumer_policy == 'drop_oldest':
+            # keep a partially sent head so the stream stays framed, and always keep the newest message
+            first = 1 if connection.head_offset else 0
+            while connection.outbound_bytes > self.server.max_queue_bytes and len(connection.outbound) > first + 1:
+                dropped = connection.outbound[first]
+                del connection.outbound[first]
+                connection.outbound_bytes -= len(dropped)
+                connection.dropped_messages += 1
+                self.dropped_messages += 1
+            return True
+
+        self.slow_consumer_disconnects += 1
+        self.server.log(f'{connection.address[0]}:{connection.address[1]} disconnected, {connection.outbound_bytes} bytes queued', self.server.error_event)
+        self.fail(connection)
+        return False
+
+    # dropping a client broadcasts its leave message, so failures found while sending are dropped on the next turn
+    # instead of recursing through every other dead connection
+    def fail(self, connection):
+        if connection.closing:
+            return
+        connection.closing = True
+        connection.outbound.clear()
+        connection.outbound_bytes = 0
+        connection.head_offset = 0
+        self.call_later(0, self.server.drop_client, connection)
+
+    # takes up to MAX_BUFFERS queued messages, the first one without its already sent part
+    def gather(self, connection):
+        buffers = [memoryview(connection.outbound[0])[connection.head_offset:]]
+        buffers.extend(itertools.islice(connection.outbound, 1, MAX_BUFFERS))
+        return buffers
+
+    # drops what a sendmsg call wrote from the front of the queue
+    def advance(self, connection, sent):
+        connection.outbound_bytes -= sent
+        sent += connection.head_offset
+        while connection.outbound and sent >= len(connection.outbound[0]):
+            sent -= len(connection.outbound.popleft())
+        connection.head_offset = sent
+
+    def queue_metrics(self):
+        connections = list(self.connections)
+        depths = [len(connection.outbound) for connection in connections]
+        return {
+            'queued_bytes': sum(connection.outbound_bytes for connection in connections),
+            'max_queue_depth': max(depths, default=0),
+            'dropped_messages': self.dropped_messages,
+            'slow_consumer_disconnects': self.slow_consumer_disconnects
+        }
+
+
+# one reader and one writer thread per client, every call into the server is serialized by a single lock
+class ThreadedEngine(Engine):
+    def __init__(self, server, listener):
+        super().__init__(server, listener)
+        self.lock = threading.RLock()
+
+    def start(self):
+        accept_thread = threading.Thread(target=self.accept_new_connections)
+        accept_thread.start()
+
+    def stop(self):
+        # the writer threads flush in parallel, so one deadline covers them all
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_SECONDS
+        for connection in list(self.connections):
+            with connection.condition:
+                connection.condition.wait_for(lambda: connection.closed or not (connection.outbound or connection.writing), timeout=max(0, deadline - time.monotonic()))
+
+        with self.lock:
+            for connection in list(self.connections):
+                self.close(connection)
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+
+    def accept_new_connections(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                break
+            connection = Connection(sock, address)
+            with self.lock:
+                self.connections.add(connection)
+            threading.Thread(target=self.handle_client, args=(connection,)).start()
+            threading.Thread(target=self.write_loop, args=(connection,)).start()
+
+    def handle_client(self, connection):
+        with self.lock:
+            self.server.on_connect(connection)
+
+        while not connection.closed:
+            try:
+                data = connection.sock.recv(self.server.buffersize)
+            except OSError:
+                data = b''
+
+            with self.lock:
+                if not data:
+                    self.server.drop_client(connection)
+                else:
+                    self.server.on_data(connection, data)
+
+            delay = connection.paused_until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            connection.paused_until = 0.0
+
+    def write_loop(self, connection):
+        while True:
+            with connection.condition:
+                connection.writing = False
+                connection.condition.notify_all()
+                connection.condition.wait_for(lambda: connection.outbound or connection.closed)
+                if connection.closed:
+                    return
+                buffers = self.gather(connection)
+                for _ in buffers:
+                    connection.outbound_bytes -= len(connection.outbound.popleft())
+                connection.writing = True
+
+            # everything that was queued goes out in as few sendmsg calls as the socket allows
+            try:
+                while buffers:
+                    sent = connection.sock.sendmsg(buffers)
+                    self.server.write_calls.inc()
+                    self.server.bytes_out.inc(sent)
+                    while buffers and sent >= len(buffers[0]):
+                        sent -= len(buffers.pop(0))
+                    if sent:
+                        buffers[0] = buffers[0][sent:]
+            except OSError:
+                self.fail(connection)
+                return
+
+    def send(self, connection, data):
+        with connection.condition:
+            if connection.closed or connection.closing:
+                return
+            if self.enqueue(connection, data):
+                connection.condition.notify_all()
+
+    def close(self, connection):
+        with connection.condition:
+            if connection.closed:
+                return
+            connection.closed = True
+            connection.condition.notify_all()
+        self.connections.discard(connection)
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.sock.close()
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self.lock:
+            callback(*args)
+
+    def call_later(self, delay, callback, *args):
+        threading.Timer(delay, self.call_soon_threadsafe, (callback,) + args).start()
+
+    # only called from the reader thread of the connection, which sleeps before its next recv
+    def pause_reading(self, connection, delay):
+        connection.paused_until = max(connection.paused_until, time.monotonic() + delay)
+
+
+# accept, handshake, receive and send for every connection on one selector loop
+class SelectorEngine(Engine):
+    def __init__(self, server, listener):
+        super().__init__(server, listener)
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        self.loop_thread = None
+
+        self.timers = []
+        self.timer_counter = itertools.count()
+        self.pending = collections.deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def start(self):
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, 'accept')
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, 'wakeup')
+        self.running = True
+        self.loop_thread = threading.Thread(target=self.run_loop)
+        self.loop_thread.start()
+
+    def stop(self):
+        self.call_soon_threadsafe(self.shutdown)
+        if self.loop_thread is not None and self.loop_thread is not threading.current_thread():
+            self.loop_thread.join()
+
+    def shutdown(self):
+        self.running = False
+
+    def run_loop(self):
+        while self.running:
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.monotonic())
+
+            for key, mask in self.selector.select(timeout):
+                if key.data == 'accept':
+                    self.accept_new_connections()
+                elif key.data == 'wakeup':
+                    self.drain_wakeup()
+                else:
+                    connection = key.data
+                    if connection.closed:
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.read(connection)
+                    if mask & selectors.EVENT_WRITE and not connection.closed:
+                        self.write(connection)
+
+            while self.pending:
+                callback, args = self.pending.popleft()
+                callback(*args)
+
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback, args = heapq.heappop(self.timers)
+                callback(*args)
+
+        self.flush_and_close()
+
+    # the queues are flushed without blocking until they are empty or the drain deadline passed,
+    # a client that stopped reading costs no more than the others
+    def flush_and_close(self):
+        self.selector.unregister(self.listener)
+        self.selector.unregister(self.wakeup_reader)
+        for connection in list(self.connections):
+            if not connection.outbound or connection.closing:
+                self.close(connection)
+            elif connection.sock in self.selector.get_map():
+                self.selector.modify(connection.sock, selectors.EVENT_WRITE, connection)
+            else:
+                # paused for going over its rate limits
+                self.selector.register(connection.sock, selectors.EVENT_WRITE, connection)
+
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_SECONDS
+        while self.connections and time.monotonic() < deadline:
+            for key, _ in self.selector.select(max(0, deadline - time.monotonic())):
+                connection = key.data
+                try:
+                    sent = connection.sock.sendmsg(self.gather(connection))
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    self.close(connection)
+                    continue
+                self.advance(connection, sent)
+                if not connection.outbound:
+                    self.close(connection)
+        for connection in list(self.connections):
+            self.close(connection)
+
+        self.listener.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+        self.selector.close()
+
+    def accept_new_connections(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                break
+            sock.setblocking(False)
+            connection = Connection(sock, address)
+            self.connections.add(connection)
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+            self.server.on_connect(connection)
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def read(self, connection):
+        try:
+            data = connection.sock.recv(self.server.buffersize)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.server.drop_client(connection)
+        else:
+            self.server.on_data(connection, data)
+
+    def write(self, connection):
+        while connection.outbound:
+            buffers = self.gather(connection)
+            try:
+                sent = connection.sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.fail(connection)
+                return
+
+            self.server.write_calls.inc()
+            self.server.bytes_out.inc(sent)
+            self.advance(connection, sent)
+            if sent < sum(len(buffer) for buffer in buffers):
+                break
+
+        if bool(connection.outbound) != connection.writing:
+            connection.writing = bool(connection.outbound)
+            self.update_events(connection)
+
+    # read interest is dropped while a connection is paused, write interest is held while its queue is not empty
+    def update_events(self, connection):
+        events = 0 if connection.paused_until else selectors.EVENT_READ
+        if connection.writing:
+            events |= selectors.EVENT_WRITE
+        registered = connection.sock in self.selector.get_map()
+        if events == 0:
+            if registered:
+                self.selector.unregister(connection.sock)
+        elif registered:
+            self.selector.modify(connection.sock, events, connection)
+        else:
+            self.selector.register(connection.sock, events, connection)
+
+    def pause_reading(self, connection, delay):
+        if connection.closed or connection.paused_until:
+            return
+        connection.paused_until = time.monotonic() + delay
+        self.update_events(connection)
+        self.call_later(delay, self.resume_reading, connection)
+
+    def resume_reading(self, connection):
+        if connection.closed:
+            return
+        connection.paused_until = 0.0
+        self.update_events(connection)
+
+    def send(self, connection, data):
+        if connection.closed or connection.closing:
+            return
+        if self.enqueue(connection, data) and not connection.writing:
+            self.write(connection)
+
+    def close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.connections.discard(connection)
+        if connection.sock in self.selector.get_map():
+            self.selector.unregister(connection.sock)
+        connection.sock.close()
+
+    def call_soon_threadsafe(self, callback, *args):
+        if threading.current_thread() is self.loop_thread:
+            callback(*args)
+            return
+        self.pending.append((callback, args))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def call_later(self, delay, callback, *args):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_counter), callback, args))
+
+
+def create_engine(mode, server, listener):
+    if mode == 'threaded':
+        return ThreadedEngine(server, listener)
+    elif mode == 'selector':
+        return SelectorEngine(server, listener)
+    raise ValueError(f'unknown network mode: {mode}')
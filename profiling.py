@@ -0,0 +1,52 @@
+import collections
+import os
+import sys
+import threading
+
+
+# samples the stack of every thread at a fixed interval, nothing is hooked into the profiled threads
+# the dump is one 'outer;...;inner count' line per stack, the collapsed format flame graph tools read
+class StackSampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.sample_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def sample_loop(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf8') as f:
+            for stack, count in self.stacks.items():
+                f.write(f'{stack} {count}\n')
+
+    # functions seen on top of a stack most often, threads waiting in the selector or on a lock included
+    def top(self, count):
+        leaves = collections.Counter()
+        for stack, samples in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += samples
+        return leaves.most_common(count)
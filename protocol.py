@@ -0,0 +1,103 @@
+import struct
+
+
+# the server opens every connection with the splitter followed by a hello frame:
+# hello<splitter>version capability,capability prompt<splitter>end<splitter>
+PROTOCOL_VERSION = 2
+SPLITTER_LENGTH = 10
+
+# binary framing, negotiated with a 'binary' frame after the hello:
+# payload length, type code and sequence number (0 for frames outside the history), then the utf8 payload
+BINARY_HEADER = struct.Struct('<IBQ')
+BINARY_TYPES = ('text', 'announcement', 'room', 'hello', 'joined', 'ping', 'pong', 'resume', 'binary', 'presence', 'roster', 'rooms')
+BINARY_TYPE_CODES = {message_type: code for code, message_type in enumerate(BINARY_TYPES)}
+
+
+def encode_binary(message_type, payload, seq=0):
+    return BINARY_HEADER.pack(len(payload), BINARY_TYPE_CODES[message_type], seq) + payload
+
+
+# message format: type<splitter>content<splitter>end<splitter>
+# a frame of stop_type is the last one decoded, whatever follows it is left for remainder() and another decoder
+class FrameDecoder:
+    def __init__(self, splitter, end_command='end', max_size=65536, stop_type=None):
+        self.splitter = splitter.encode('utf8')
+        self.end_command = end_command
+        self.max_size = max_size
+        self.stop_type = stop_type
+
+        self.buffer = bytearray()
+        self.search_start = 0
+        self.fields = []
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+
+        # fields are only decoded once their closing splitter arrived, so split utf8 sequences wait in the buffer
+        field_start = 0
+        while True:
+            index = self.buffer.find(self.splitter, self.search_start)
+            if index == -1:
+                break
+
+            self.fields.append(self.buffer[field_start:index].decode('utf8', errors='replace'))
+            field_start = index + len(self.splitter)
+            self.search_start = field_start
+
+            if len(self.fields) == 3:
+                if self.fields[2] == self.end_command:
+                    messages.append((self.fields[0], self.fields[1]))
+                    self.fields = []
+                    if messages[-1][0] == self.stop_type:
+                        break
+                else:
+                    # out of step with the sender, drop the oldest field and try to line up again
+                    del self.fields[0]
+
+        del self.buffer[:field_start]
+        # a splitter cut by the read boundary can start at most len(splitter) - 1 bytes from the end
+        self.search_start = max(0, len(self.buffer) - len(self.splitter) + 1)
+
+        if len(self.buffer) > self.max_size:
+            raise ValueError(f'frame exceeds {self.max_size} bytes')
+
+        return messages
+
+    def remainder(self):
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.search_start = 0
+        return data
+
+
+# frames are cut out of the received bytes with memoryview slices, only a frame split by the read boundary is copied
+class BinaryDecoder:
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self.pending = b''
+
+    # (type, seq, payload) per complete frame, the payload is a memoryview into the received bytes
+    def frames(self, data):
+        if self.pending:
+            data = self.pending + data
+        view = memoryview(data)
+        frames = []
+        position = 0
+        while len(view) - position >= BINARY_HEADER.size:
+            length, code, seq = BINARY_HEADER.unpack_from(view, position)
+            if length > self.max_size:
+                raise ValueError(f'frame exceeds {self.max_size} bytes')
+            if code >= len(BINARY_TYPES):
+                raise ValueError(f'unknown frame type {code}')
+            start = position + BINARY_HEADER.size
+            if start + length > len(view):
+                break
+            frames.append((BINARY_TYPES[code], seq, view[start:start + length]))
+            position = start + length
+        self.pending = bytes(view[position:])
+        return frames
+
+    # same result as FrameDecoder.feed
+    def feed(self, data):
+        return [(message_type, str(payload, 'utf8', 'replace')) for message_type, _, payload in self.frames(data)]
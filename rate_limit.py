@@ -0,0 +1,66 @@
+import collections
+import time
+
+
+# tokens may go negative, the debt is how long the sender has to wait before it is read again
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, amount, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+# message and byte buckets per connection and per ip, with limits taken from a profile ('user' or 'admin')
+# a rate of 0 in the profile means unlimited
+class RateLimiter:
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.connection_buckets = {}
+        self.ip_buckets = {}
+        self.ip_connections = collections.Counter()
+
+        self.limited = 0
+        self.limited_by_ip = collections.Counter()
+
+    def add(self, connection):
+        self.connection_buckets[connection] = {}
+        self.ip_connections[connection.address[0]] += 1
+        self.ip_buckets.setdefault(connection.address[0], {})
+
+    def remove(self, connection):
+        if self.connection_buckets.pop(connection, None) is None:
+            return
+        ip = connection.address[0]
+        self.ip_connections[ip] -= 1
+        if self.ip_connections[ip] <= 0:
+            del self.ip_connections[ip]
+            del self.ip_buckets[ip]
+
+    # kind is 'messages' or 'bytes', returns the seconds the connection is over its limits
+    def consume(self, connection, profile, kind, amount):
+        buckets = self.connection_buckets.get(connection)
+        if buckets is None:
+            return 0.0
+        limits = self.profiles[profile]
+        now = time.monotonic()
+        wait = 0.0
+        for prefix, owner in (('', buckets), ('ip_', self.ip_buckets[connection.address[0]])):
+            rate = limits[f'{prefix}{kind}_per_second']
+            if rate <= 0:
+                continue
+            bucket = owner.get((profile, kind))
+            if bucket is None:
+                bucket = owner[(profile, kind)] = TokenBucket(rate, limits[f'{prefix}{kind}_burst'])
+            wait = max(wait, bucket.consume(amount, now))
+
+        if wait > 0:
+            self.limited += 1
+            self.limited_by_ip[connection.address[0]] += 1
+        return wait
@@ -0,0 +1,85 @@
+import struct
+import time
+
+
+TRACE_MAGIC = b'CHATTRC1'
+
+# record: kind, connection id, microseconds since the recording started
+# frame records continue with the type length, the content length, the type and the content
+RECORD_HEADER = struct.Struct('<BIQ')
+FRAME_HEADER = struct.Struct('<BI')
+
+CONNECT = 0
+# a frame sent before the name was accepted, usually the name itself
+HELLO_FRAME = 1
+FRAME = 2
+CLOSE = 3
+
+
+# appends the inbound frames of every connection to a compact binary trace, called from the engine thread only
+class TraceWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_MAGIC)
+        self.started = time.monotonic()
+        self.ids = {}
+        self.next_id = 0
+        self.frames = 0
+
+    def write(self, kind, connection_id, extra=b''):
+        offset = int((time.monotonic() - self.started) * 1000000)
+        self.file.write(RECORD_HEADER.pack(kind, connection_id, offset) + extra)
+
+    def connect(self, connection):
+        self.ids[connection] = self.next_id
+        self.next_id += 1
+        self.write(CONNECT, self.ids[connection])
+
+    def frame(self, connection, message_type, content):
+        if connection not in self.ids:
+            # connected before the recording started, a replay has to register the same name first
+            self.connect(connection)
+            if connection.state != 'hello':
+                self.write_frame(HELLO_FRAME, connection, 'text', connection.name)
+        self.write_frame(HELLO_FRAME if connection.state == 'hello' else FRAME, connection, message_type, content)
+
+    def write_frame(self, kind, connection, message_type, content):
+        message_type = message_type.encode('utf8')
+        content = content.encode('utf8')
+        self.write(kind, self.ids[connection], FRAME_HEADER.pack(len(message_type), len(content)) + message_type + content)
+        self.frames += 1
+
+    def close(self, connection):
+        connection_id = self.ids.pop(connection, None)
+        if connection_id is not None:
+            self.write(CLOSE, connection_id)
+
+    def stop(self):
+        self.file.close()
+
+
+# yields (seconds, kind, connection id, type, content) for every record, type and content are None for connects and closes
+def read_trace(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise ValueError(f'{path} is not a chat trace')
+
+    position = len(TRACE_MAGIC)
+    while position + RECORD_HEADER.size <= len(data):
+        kind, connection_id, offset = RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        message_type = content = None
+        if kind in (HELLO_FRAME, FRAME):
+            if position + FRAME_HEADER.size > len(data):
+                break
+            type_length, content_length = FRAME_HEADER.unpack_from(data, position)
+            position += FRAME_HEADER.size
+            if position + type_length + content_length > len(data):
+                break
+            message_type = data[position:position + type_length].decode('utf8')
+            position += type_length
+            content = data[position:position + content_length].decode('utf8')
+            position += content_length
+        yield offset / 1000000, kind, connection_id, message_type, content
@@ -0,0 +1,312 @@
+import argparse
+import collections
+import json
+import os
+import resource
+import selectors
+import shutil
+import socket
+import subprocess
+import time
+from benchmark import percentiles, process_stats, raise_file_limit, spawn_server
+from protocol import FrameDecoder, SPLITTER_LENGTH
+from recorder import read_trace, CONNECT, HELLO_FRAME, FRAME, CLOSE
+
+
+# commands that control the recording server itself and would stop or disturb the server under test
+SKIPPED_COMMANDS = ('!stop', '!record', '!profile', '!memtrace')
+
+
+class ReplayConnection:
+    def __init__(self, connection_id, address):
+        self.connection_id = connection_id
+        self.splitter = None
+        self.decoder = None
+        self.pending = b''
+        # frames of the trace that are due before the splitter arrived, None for the close
+        self.waiting = []
+        self.outbound = bytearray()
+        # chat lines sent and not seen back yet, with the time they were sent
+        self.expected = collections.deque()
+        self.trace_closed = False
+        self.closed = False
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.connect_ex(address)
+
+    def encode(self, message_type, content):
+        return f'{message_type}{self.splitter}{content}{self.splitter}end{self.splitter}'.encode('utf8')
+
+
+# plays the connections of a recorded trace against a server from one selector loop, keeping the recorded timing
+# scaled by speed, and measures how long each chat line takes to come back and how many never do
+class TraceReplayer:
+    def __init__(self, events, address, speed, drain):
+        self.events = events
+        self.address = address
+        self.speed = speed
+        self.drain = drain
+
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}
+        self.latencies = []
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.expected = 0
+        self.missing = 0
+        self.unconfirmed = 0
+        self.closed_by_server = 0
+        self.error_announcements = 0
+        self.messages_received = 0
+        self.bytes_received = 0
+
+    def run(self):
+        started = time.perf_counter()
+        position = 0
+        while position < len(self.events):
+            now = time.perf_counter()
+            while position < len(self.events) and (not self.speed or started + self.events[position][0] / self.speed <= now):
+                self.apply(*self.events[position])
+                position += 1
+            timeout = 0.01
+            if self.speed and position < len(self.events):
+                timeout = max(0, min(started + self.events[position][0] / self.speed - time.perf_counter(), 0.01))
+            self.poll(timeout)
+        replayed = time.perf_counter()
+
+        deadline = time.perf_counter() + self.drain
+        while time.perf_counter() < deadline:
+            self.poll(0.05)
+        for connection in list(self.connections.values()):
+            self.close(connection)
+
+        return {
+            'connections': len(self.connections),
+            'trace_seconds': round(self.events[-1][0], 3) if self.events else 0,
+            'replay_seconds': round(replayed - started, 3),
+            'speed': self.speed or 'max',
+            'frames_sent': self.frames_sent,
+            'frames_skipped': self.frames_skipped,
+            'chat_lines': self.expected,
+            'chat_lines_missing': self.missing,
+            'chat_lines_unconfirmed': self.unconfirmed,
+            'latency_ms': percentiles(self.latencies),
+            'closed_by_server': self.closed_by_server,
+            'error_announcements': self.error_announcements,
+            'messages_received': self.messages_received,
+            'bytes_received': self.bytes_received
+        }
+
+    def apply(self, offset, kind, connection_id, message_type, content):
+        if kind == CONNECT:
+            connection = ReplayConnection(connection_id, self.address)
+            self.connections[connection_id] = connection
+            self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+            return
+
+        connection = self.connections.get(connection_id)
+        if connection is None or connection.closed:
+            return
+        if kind == CLOSE:
+            if connection.splitter is None:
+                connection.waiting.append(None)
+                return
+            connection.trace_closed = True
+            if not connection.outbound:
+                self.close(connection)
+        elif kind in (HELLO_FRAME, FRAME):
+            # replays always speak the text framing, a client's switch to binary framing is left out
+            if message_type == 'binary' or message_type == 'text' and content.split(' ', 1)[0] in SKIPPED_COMMANDS:
+                self.frames_skipped += 1
+                return
+            chat_line = kind == FRAME and message_type == 'text' and not content.startswith('!') and content != '{quit}'
+            if connection.splitter is None:
+                connection.waiting.append((message_type, content, chat_line))
+            else:
+                self.send(connection, message_type, content, chat_line)
+
+    def send(self, connection, message_type, content, chat_line):
+        if connection.closed:
+            return
+        if message_type == 'text' and content == '{quit}':
+            # the server closes the connection now, that is not a drop
+            connection.trace_closed = True
+        if chat_line:
+            connection.expected.append((': ' + content, time.perf_counter()))
+            self.expected += 1
+        connection.outbound += connection.encode(message_type, content)
+        self.frames_sent += 1
+        self.flush(connection)
+
+    def flush(self, connection):
+        try:
+            sent = connection.sock.send(connection.outbound)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.close(connection)
+            return
+        del connection.outbound[:sent]
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if connection.outbound else selectors.EVENT_READ
+        self.selector.modify(connection.sock, events, connection)
+        if not connection.outbound and connection.trace_closed:
+            self.close(connection)
+
+    def poll(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            connection = key.data
+            if mask & selectors.EVENT_WRITE:
+                self.flush(connection)
+            if connection.closed or not mask & selectors.EVENT_READ:
+                continue
+            try:
+                data = connection.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                if not connection.trace_closed:
+                    self.closed_by_server += 1
+                self.close(connection)
+                continue
+            self.bytes_received += len(data)
+            self.handle_data(connection, data)
+
+    def handle_data(self, connection, data):
+        if connection.splitter is None:
+            connection.pending += data
+            if len(connection.pending) < SPLITTER_LENGTH:
+                return
+            connection.splitter = connection.pending[:SPLITTER_LENGTH].decode('utf8')
+            connection.decoder = FrameDecoder(connection.splitter)
+            data = connection.pending[SPLITTER_LENGTH:]
+            connection.pending = b''
+            waiting, connection.waiting = connection.waiting, []
+            for frame in waiting:
+                if frame is None:
+                    connection.trace_closed = True
+                    if not connection.outbound:
+                        self.close(connection)
+                else:
+                    self.send(connection, *frame)
+                if connection.closed:
+                    return
+
+        now = time.perf_counter()
+        for message_type, content in connection.decoder.feed(data):
+            self.messages_received += 1
+            if message_type == 'ping':
+                # real clients answer pings, an idle stretch of the trace must not get them dropped
+                self.send(connection, 'pong', content, False)
+            elif message_type == 'announcement' and content.startswith('ERROR: '):
+                self.error_announcements += 1
+            elif message_type in ('text', 'room'):
+                # lines come back in the order they were sent, the ones skipped over were lost
+                for index, (ending, sent) in enumerate(connection.expected):
+                    if index == 64:
+                        break
+                    if content.endswith(ending):
+                        self.latencies.append((now - sent) * 1000)
+                        self.missing += index
+                        for _ in range(index + 1):
+                            connection.expected.popleft()
+                        break
+
+    # lines of a connection the trace closed may still have arrived, only the ones of connections still open are lost
+    def close(self, connection):
+        if not connection.closed:
+            if connection.trace_closed:
+                self.unconfirmed += len(connection.expected)
+            else:
+                self.missing += len(connection.expected)
+            connection.closed = True
+            self.selector.unregister(connection.sock)
+            connection.sock.close()
+
+
+# prints the metrics of two replay results of the same trace side by side
+def compare(first_path, second_path):
+    with open(first_path, 'r') as f:
+        first = json.load(f)
+    with open(second_path, 'r') as f:
+        second = json.load(f)
+
+    rows = []
+    for key in ('replay_seconds', 'frames_sent', 'chat_lines', 'chat_lines_missing', 'chat_lines_unconfirmed', 'closed_by_server', 'error_announcements', 'messages_received'):
+        rows.append((key, first.get(key), second.get(key)))
+    for key in ('p50', 'p90', 'p99', 'p999', 'max', 'mean'):
+        rows.append((f'latency_ms {key}', first['latency_ms'].get(key), second['latency_ms'].get(key)))
+    if 'server' in first and 'server' in second:
+        for key in ('cpu_seconds', 'peak_rss_kb'):
+            rows.append((f'server {key}', first['server'][key], second['server'][key]))
+
+    print(f'{"":24} {os.path.basename(first_path):>16} {os.path.basename(second_path):>16} {"change":>9}')
+    for name, a, b in rows:
+        change = ''
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a:
+            change = f'{(b - a) / a * 100:+.1f}%'
+        print(f'{name:24} {str(a):>16} {str(b):>16} {change:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replays a trace recorded with !record against a chat server')
+    parser.add_argument('trace', nargs='?', help='trace file written by !record')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=25565)
+    parser.add_argument('--speed', type=float, default=1, help='1 keeps the recorded timing, 10 plays it ten times faster, 0 as fast as possible')
+    parser.add_argument('--drain', type=float, default=2, help='seconds to keep reading after the last event')
+    parser.add_argument('--spawn', choices=['threaded', 'selector'], help='start a headless server in this mode for the run')
+    parser.add_argument('--server-dir', default='.', help='checkout the spawned server runs from, to compare builds')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the spawned server')
+    parser.add_argument('--config', help='config the spawned server is based on, defaults to the one in --server-dir')
+    parser.add_argument('--output', help='write the json result to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('FIRST', 'SECOND'), help='compare two json results instead of replaying')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.trace is None:
+        parser.error('a trace is needed unless --compare is given')
+
+    raise_file_limit()
+    events = list(read_trace(args.trace))
+
+    process = None
+    run_directory = None
+    if args.spawn:
+        base_config = args.config or os.path.join(args.server_dir, 'data/config.json')
+        process, run_directory = spawn_server(args.spawn, args.port, base_config, args.workers, args.server_dir)
+    server_before = process_stats(process.pid) if process else None
+    own_before = resource.getrusage(resource.RUSAGE_SELF)
+
+    result = TraceReplayer(events, (args.host, args.port), args.speed, args.drain).run()
+
+    own_after = resource.getrusage(resource.RUSAGE_SELF)
+    result['replayer_cpu_seconds'] = round(own_after.ru_utime + own_after.ru_stime - own_before.ru_utime - own_before.ru_stime, 3)
+    result['config'] = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+
+    if process is not None:
+        server_after = process_stats(process.pid)
+        if server_before and server_after:
+            result['server'] = dict(server_after, cpu_seconds=round(server_after['cpu_seconds'] - server_before['cpu_seconds'], 3))
+        process.stdin.write('!stop\n')
+        process.stdin.flush()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+    output = json.dumps(result, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import threading
+
+
+# subscribers per room, a message to a room is only queued for the connections in its set
+class RoomRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.members = {}
+
+    def join(self, connection, room):
+        with self.lock:
+            subscribers = self.members.setdefault(room, set())
+            if connection in subscribers:
+                return False
+            subscribers.add(connection)
+            connection.rooms.add(room)
+            return True
+
+    def leave(self, connection, room):
+        with self.lock:
+            subscribers = self.members.get(room)
+            if subscribers is None or connection not in subscribers:
+                return False
+            subscribers.discard(connection)
+            connection.rooms.discard(room)
+            if not subscribers:
+                del self.members[room]
+            return True
+
+    def leave_all(self, connection):
+        with self.lock:
+            rooms = list(connection.rooms)
+            for room in rooms:
+                self.leave(connection, room)
+            return rooms
+
+    def subscribers(self, room):
+        with self.lock:
+            return list(self.members.get(room, ()))
+
+    def counts(self):
+        with self.lock:
+            return {room: len(subscribers) for room, subscribers in self.members.items()}
@@ -0,0 +1,67 @@
+import collections
+import pygame
+
+
+# draws only the visible window of a growing list of lines, each line is rendered once and cached
+class Scrollback:
+    def __init__(self, font, lines, width, height, color=(174, 174, 174), cache_size=256):
+        self.font = font
+        self.lines = lines
+        self.width = width
+        self.height = height
+        self.color = color
+
+        self.line_height = self.font.get_linesize()
+        self.padding = 10
+        self.scroll_step = 15
+
+        # distance in pixels from the newest line, 0 means the view follows new lines
+        self.bottom_offset = 0
+        self.line_count = len(self.lines)
+
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def content_height(self):
+        return self.line_count * self.line_height + 2 * self.padding
+
+    def update(self):
+        line_count = len(self.lines)
+        if self.bottom_offset > 0 and line_count > self.line_count:
+            self.bottom_offset += (line_count - self.line_count) * self.line_height
+        self.line_count = line_count
+        self.bottom_offset = min(self.bottom_offset, max(0, self.content_height() - self.height))
+
+    def scroll_up(self):
+        self.bottom_offset = min(self.bottom_offset + self.scroll_step, max(0, self.content_height() - self.height))
+
+    def scroll_down(self):
+        self.bottom_offset = max(0, self.bottom_offset - self.scroll_step)
+
+    def render_line(self, line):
+        surface = self.cache.get(line)
+        if surface is None:
+            surface = self.font.render(line, True, self.color)
+            self.cache[line] = surface
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(line)
+        return surface
+
+    def draw(self, screen):
+        self.update()
+
+        top = min(0, self.height - self.content_height() + self.bottom_offset) + self.padding
+        first = max(0, -top // self.line_height)
+        last = min(self.line_count, (self.height - top) // self.line_height + 1)
+
+        for i in range(first, last):
+            screen.blit(self.render_line(self.lines[i]), (self.padding, top + i * self.line_height))
+
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            if event.button == 4:
+                self.scroll_up()
+            elif event.button == 5:
+                self.scroll_down()
@@ -0,0 +1,147 @@
+import array
+import bisect
+import os
+import re
+import struct
+import zlib
+
+
+INDEX_MAGIC = b'CHATIDX1'
+# last indexed sequence number, messages, authors, tokens
+INDEX_HEADER = struct.Struct('<QIII')
+TOKEN_HEADER = struct.Struct('<HI')
+
+TOKEN_PATTERN = re.compile(r'\w+')
+# longer words are left out of the index, nobody searches for them
+MAX_TOKEN_LENGTH = 64
+
+
+def tokenize(text):
+    return {token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) <= MAX_TOKEN_LENGTH}
+
+
+# inverted index from lowercase words to the sequence numbers of the messages containing them,
+# with the author and time of every message in arrays parallel to the sorted sequence numbers
+# sequence numbers only grow, so every posting list stays sorted by appending
+class SearchIndex:
+    def __init__(self, path):
+        self.path = path
+        self.last_seq = 0
+        self.postings = {}
+        self.seqs = array.array('Q')
+        self.authors = array.array('I')
+        self.times = array.array('d')
+        self.author_names = []
+        self.author_ids = {}
+        if os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def add(self, seq, timestamp, author, text):
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        tokens = tokenize(text)
+        if not tokens:
+            return
+
+        author_id = self.author_ids.get(author)
+        if author_id is None:
+            author_id = self.author_ids[author] = len(self.author_names)
+            self.author_names.append(author)
+        self.seqs.append(seq)
+        self.authors.append(author_id)
+        self.times.append(timestamp)
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array.array('Q')
+            postings.append(seq)
+
+    # newest messages containing every term first, as (seq, time, author), optionally only those of one author
+    def search(self, terms, limit, author=None):
+        author_id = None
+        if author is not None:
+            author_id = self.author_ids.get(author)
+            if author_id is None:
+                return []
+
+        # terms are split the way messages were, 'hello,' and "don't" look up the same words they were indexed as
+        tokens = set()
+        for term in terms:
+            tokens |= tokenize(term)
+        lists = []
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                return []
+            lists.append(postings)
+        if not lists:
+            return []
+        lists.sort(key=len)
+
+        # walk the rarest term from the newest end and look the others up by bisection
+        matches = []
+        shortest, others = lists[0], lists[1:]
+        for i in range(len(shortest) - 1, -1, -1):
+            seq = shortest[i]
+            if all(contains(postings, seq) for postings in others):
+                position = bisect.bisect_left(self.seqs, seq)
+                if author_id is not None and self.authors[position] != author_id:
+                    continue
+                matches.append((seq, self.times[position], self.author_names[self.authors[position]]))
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    # one zlib stream behind a small header, written next to the old file and renamed over it
+    def save(self):
+        names = '\0'.join(self.author_names).encode('utf8')
+        parts = [struct.pack('<I', len(names)), names, self.seqs.tobytes(), self.authors.tobytes(), self.times.tobytes()]
+        for token, postings in self.postings.items():
+            encoded = token.encode('utf8')
+            parts.append(TOKEN_HEADER.pack(len(encoded), len(postings)))
+            parts.append(encoded)
+            parts.append(postings.tobytes())
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(INDEX_HEADER.pack(self.last_seq, len(self.seqs), len(self.author_names), len(self.postings)))
+            f.write(zlib.compress(b''.join(parts), 1))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f'{self.path} is not a search index')
+        self.last_seq, messages, author_count, token_count = INDEX_HEADER.unpack_from(data, len(INDEX_MAGIC))
+        body = memoryview(zlib.decompress(data[len(INDEX_MAGIC) + INDEX_HEADER.size:]))
+
+        length, = struct.unpack_from('<I', body, 0)
+        position = 4 + length
+        self.author_names = str(body[4:position], 'utf8').split('\0') if author_count else []
+        self.author_ids = {author: author_id for author_id, author in enumerate(self.author_names)}
+        for column in (self.seqs, self.authors, self.times):
+            size = messages * column.itemsize
+            column.frombytes(body[position:position + size])
+            position += size
+
+        for _ in range(token_count):
+            token_length, count = TOKEN_HEADER.unpack_from(body, position)
+            position += TOKEN_HEADER.size
+            token = str(body[position:position + token_length], 'utf8')
+            position += token_length
+            postings = self.postings[token] = array.array('Q')
+            postings.frombytes(body[position:position + count * 8])
+            position += count * 8
+
+
+def contains(postings, seq):
+    i = bisect.bisect_left(postings, seq)
+    return i < len(postings) and postings[i] == seq
@@ -0,0 +1,988 @@
+import socket
+import random
+import secrets
+import datetime
+import hmac
+import json
+import os
+import threading
+import time
+import cProfile
+import pstats
+import tracemalloc
+from network import create_engine
+from protocol import FrameDecoder, BinaryDecoder, encode_binary, BINARY_HEADER, BINARY_TYPE_CODES, PROTOCOL_VERSION, SPLITTER_LENGTH
+from line_buffer import LineBuffer
+from sessions import SessionRegistry
+from rooms import RoomRegistry
+from rate_limit import RateLimiter
+from log_pipeline import LogPipeline
+from admin_store import AdminStore
+from metrics import Metrics, MetricsEndpoint, exponential_buckets
+from history import History
+from timer_wheel import TimerWheel
+from profiling import StackSampler
+from recorder import TraceWriter
+from search_index import SearchIndex
+from cluster import BusClient
+
+
+class Command:
+    def __init__(self, name, usage, handler, permission):
+        self.name = name
+        self.usage = usage
+        self.handler = handler
+        self.permission = permission
+
+
+# message format: type:content,content:end
+class ServerCore:
+    def __init__(self, config_path='data/config.json', worker=None):
+        self.running = True
+        self.worker = worker
+        self.stopped = threading.Event()
+
+        self.hostname = socket.gethostname()
+        self.local_ip = socket.gethostbyname(self.hostname)
+
+        self.text_type = 'text'
+        self.announcement_type = 'announcement'
+        # content of a room message is the room name, a space and the line
+        self.room_type = 'room'
+        self.hello_type = 'hello'
+        # a seq frame carries the sequence number of the broadcast that follows it
+        self.seq_type = 'seq'
+        # sent once the name is accepted, content is the name and the session's resume token
+        self.joined_type = 'joined'
+        # instead of a plain name a client may send '<last seen sequence number> <name> <resume token> <rooms>' to get only
+        # what it missed, rooms being the content of the last rooms frame it got
+        self.resume_type = 'resume'
+        # sent whenever the rooms of a client change: the room it talks in first, then its other rooms, space separated
+        self.rooms_type = 'rooms'
+        # either side may send a ping, the other answers with a pong carrying the same content
+        # a client that sends one answers pings too, only those clients are pinged and dropped when they go silent
+        self.ping_type = 'ping'
+        self.pong_type = 'pong'
+        # a client sends a binary frame after the hello, the server answers with one, after which both sides
+        # use length prefixed binary frames that carry the sequence number themselves instead of seq frames
+        self.binary_type = 'binary'
+        # a client that sends a presence frame gets a roster frame with every name at join, then presence frames
+        # with '+name' and '-name' lines instead of the joined and left announcements
+        self.presence_type = 'presence'
+        self.roster_type = 'roster'
+        self.capabilities = ['rooms', 'history', 'seq', 'resume', 'ping', 'binary', 'presence']
+        self.end_command = 'end'
+        # message types are stored in the history as their index in this list
+        self.message_types = [self.text_type, self.announcement_type, self.room_type]
+        self.frame_types = self.message_types + [self.hello_type, self.seq_type, self.joined_type, self.ping_type, self.pong_type, self.binary_type, self.presence_type, self.roster_type, self.rooms_type]
+        self.message_splitter = ''.join(chr(random.randint(33, 126)) for _ in range(SPLITTER_LENGTH))
+
+        self.log_listeners = []
+
+        self.session_start = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.shutdown_timer = -2
+        # one countdown runs at a time, another !stop <seconds> only sets the seconds left
+        self.shutdown_countdown = False
+
+        self.error_event = 'ERROR: '
+        self.usage_error_event = 'USAGE ERROR: '
+        self.user_info_event = 'USER INFO: '
+
+        self.commands = {}
+        self.register_command('!broadcast', '!broadcast <message>', self.command_broadcast)
+        self.register_command('!getinfo', '!getinfo <username>', self.command_getinfo)
+        self.register_command('!setop', '!setop <username>', self.command_setop)
+        self.register_command('!help', '!help <optional: command>', self.command_help)
+        self.register_command('!stop', '!stop <optional: seconds>', self.command_stop)
+        self.register_command('!stats', '!stats', self.command_stats)
+        self.register_command('!join', '!join <room>', self.command_join, 0)
+        self.register_command('!leave', '!leave <optional: room>', self.command_leave, 0)
+        self.register_command('!rooms', '!rooms', self.command_rooms, 0)
+        self.register_command('!profile', '!profile <start|stop> <optional: sample|cprofile>', self.command_profile)
+        self.register_command('!memtrace', '!memtrace <start|stop>', self.command_memtrace)
+        self.register_command('!record', '!record <start|stop>', self.command_record)
+        self.register_command('!search', '!search <terms> <optional: from:username>', self.command_search)
+
+        with open(config_path, 'r') as f:
+            self.config = json.load(f)
+
+        # workers of one cluster keep their own scrollback and history files
+        self.worker_suffix = '' if worker is None else f'.worker{worker}'
+        self.log_prefix = '' if worker is None else f'worker {worker}: '
+
+        self.screen_text = LineBuffer(self.config['scrollback_capacity'], self.config['scrollback_spill_file'] + self.worker_suffix)
+
+        log_file = self.config['log_file'] + self.worker_suffix if self.config['log_file'] else ''
+        self.log_pipeline = LogPipeline(log_file, self.config['log_max_bytes'], self.config['log_max_age'], self.config['log_backups'], [self.add_line])
+
+        self.history = History(self.config['history_dir'] + self.worker_suffix, self.config['history_segment_bytes'])
+        self.history_replay = self.config['history_replay']
+        self.history_resume_limit = self.config['history_resume_limit']
+        # the index is saved on shutdown, whatever the history got after that is indexed again on start
+        self.search_index = SearchIndex(self.config['search_index_file'] + self.worker_suffix)
+        self.search_results = self.config['search_results']
+        for seq, timestamp, message_type, payload in self.history.read_since(self.search_index.last_seq):
+            self.index_message(seq, timestamp, self.message_types[message_type], str(payload, 'utf8'))
+        # next_seq the encoded replay was made at and the replay, for text and for binary clients
+        self.replay_cache = {False: (None, b''), True: (None, b'')}
+
+        # profiler and tracemalloc only exist between start and stop, the server runs untouched otherwise
+        self.profile_dir = self.config['profile_dir']
+        self.profiler = None
+        # inbound frames of every connection go to a trace for replay.py while this is set
+        self.recorder = None
+
+        # network
+        self.sessions = SessionRegistry()
+        self.rooms = RoomRegistry()
+        self.default_room = self.config['default_room']
+        # all workers know the same admins, one of them writes the store
+        self.admins = AdminStore(self.config['admins_file'], persist=not worker)
+
+        self.host = ''
+        self.port = self.config['port']
+        self.buffersize = 4096
+        self.max_queue_bytes = self.config['max_queue_bytes']
+        self.slow_consumer_policy = self.config['slow_consumer_policy']
+        self.handshake_timeout = self.config['handshake_timeout']
+        # a client that pings, silent for heartbeat_interval seconds is pinged, silent for idle_timeout seconds is dropped,
+        # 0 turns either off
+        self.heartbeat_interval = self.config['heartbeat_interval']
+        self.idle_timeout = self.config['idle_timeout']
+        # every connection sits in exactly one slot, a tick only looks at the connections due in it
+        self.idle_wheel = TimerWheel(1, 64)
+        self.rate_limiter = RateLimiter(self.config['rate_limits'])
+        self.rate_limit_action = self.config['rate_limit_action']
+        self.coalesce_window = self.config['coalesce_window_ms'] / 1000
+        # runs of broadcasts to the same room in the order they were sequenced: [room, parts, binary parts]
+        self.coalesced = []
+        # joins and leaves since the last presence flush, name -> joined
+        self.presence_interval = self.config['presence_interval_ms'] / 1000
+        self.presence_changes = {}
+        self.presence_flush_scheduled = False
+        self.address = (self.host, self.port)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if worker is not None:
+            # every worker binds the same port and the kernel spreads new connections between them
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind(self.address)
+
+        # names registered on the other workers, kept up to date by the bus
+        self.remote_names = set()
+        self.bus = None
+        if worker is not None:
+            self.bus = BusClient(self.config['bus_path'], worker, self.on_bus_event)
+
+        self.network_mode = self.config['network_mode']
+        self.engine = create_engine(self.network_mode, self, self.server)
+
+        # metrics
+        self.metrics = Metrics()
+        self.messages_in = self.metrics.counter('messages_in', 'frames received from clients')
+        self.messages_out = self.metrics.counter('messages_out', 'frames queued for clients')
+        self.bytes_in = self.metrics.counter('bytes_in', 'bytes received from clients')
+        self.bytes_out = self.metrics.counter('bytes_out', 'bytes written to clients')
+        self.write_calls = self.metrics.counter('write_calls', 'send calls on client sockets')
+        self.rate_limited = self.metrics.counter('rate_limited', 'reads that put a client over its rate limits')
+        self.idle_disconnects = self.metrics.counter('idle_disconnects', 'clients dropped for not answering pings')
+        self.broadcast_time = self.metrics.histogram('broadcast_seconds', 'time to queue one broadcast for every recipient', exponential_buckets(0.00001, 4, 10))
+        self.handshake_time = self.metrics.histogram('handshake_seconds', 'time from accept to registered name', exponential_buckets(0.001, 2, 14))
+        self.ping_time = self.metrics.histogram('ping_seconds', 'time from ping to pong', exponential_buckets(0.001, 2, 14))
+        self.metrics.gauge('connected_clients', 'registered clients', lambda: len(self.sessions))
+        self.metrics.gauge('queued_bytes', 'bytes waiting in all outbound queues', lambda: self.engine.queue_metrics()['queued_bytes'])
+        self.metrics.gauge('max_queue_depth', 'messages waiting in the fullest outbound queue', lambda: self.engine.queue_metrics()['max_queue_depth'])
+        self.metrics.gauge('dropped_messages', 'messages dropped by the drop_oldest policy', lambda: self.engine.dropped_messages)
+        self.metrics.gauge('slow_consumer_disconnects', 'clients dropped by the disconnect policy', lambda: self.engine.slow_consumer_disconnects)
+        self.metrics_endpoint = None
+        if self.config['metrics_port']:
+            self.metrics_endpoint = MetricsEndpoint(self.metrics, self.config['metrics_host'], self.config['metrics_port'] + (worker or 0))
+
+    def start(self):
+        self.server.listen(self.config['listen_backlog'])
+        self.log(f'Waiting for connection... ({self.network_mode} mode)')
+        self.engine.start()
+        if self.bus is not None:
+            self.bus.start()
+        self.engine.call_soon_threadsafe(self.engine.call_later, 1, self.sample_metrics)
+        self.engine.call_soon_threadsafe(self.engine.call_later, self.idle_wheel.tick, self.check_idle)
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.start()
+            self.log(f'metrics on http://{self.config["metrics_host"]}:{self.config["metrics_port"]}/metrics')
+
+    def shutdown(self):
+        self.engine.call_soon_threadsafe(self.deliver, self.announcement_type, 'Server stopped')
+        self.engine.call_soon_threadsafe(self.flush_broadcasts)
+        self.engine.stop()
+        if self.bus is not None:
+            self.bus.stop()
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.stop()
+
+        if self.recorder is not None:
+            self.recorder.stop()
+        self.admins.close()
+        self.log_pipeline.close()
+        self.screen_text.close()
+        self.search_index.save()
+        self.history.close()
+
+    def request_stop(self, local=False):
+        if self.bus is not None and self.running and not local:
+            self.bus.publish({'event': 'stop'})
+        self.running = False
+        self.stopped.set()
+
+    def count_down_shutdown(self):
+        self.shutdown_timer -= 1
+        if self.shutdown_timer <= 0:
+            self.request_stop()
+        else:
+            self.engine.call_later(1, self.count_down_shutdown)
+
+    def sample_metrics(self):
+        self.metrics.sample()
+        if self.running:
+            self.engine.call_later(1, self.sample_metrics)
+
+    def submit_command(self, raw_command):
+        self.engine.call_soon_threadsafe(self.handle_command, raw_command)
+
+    # called on the bus reader thread with events published by the other workers
+    def on_bus_event(self, event):
+        self.engine.call_soon_threadsafe(self.handle_bus_event, event)
+
+    def handle_bus_event(self, event):
+        kind = event['event']
+        # every worker has its own splitter, a name or line carrying this one must not reach the text clients here
+        if any(isinstance(value, str) and self.message_splitter in value for value in event.values()):
+            return
+        if kind == 'broadcast':
+            self.deliver(event['type'], event['content'], event['room'])
+        elif kind == 'join':
+            self.remote_names.add(event['name'])
+            self.presence_change(event['name'], True)
+        elif kind == 'leave':
+            self.remote_names.discard(event['name'])
+            self.presence_change(event['name'], False)
+        elif kind == 'admin':
+            self.admins.set(event['ip'], event['level'])
+        elif kind == 'setop':
+            session = self.sessions.get_by_name(event['name'])
+            if session is not None and self.admins.get(session.address[0]) != 1:
+                self.admins.set(session.address[0], 1)
+                self.publish({'event': 'admin', 'ip': session.address[0], 'level': 1})
+                self.send(session, self.announcement_type, 'you are now an admin')
+        elif kind == 'command':
+            self.handle_command(event['command'])
+        elif kind == 'stop':
+            self.request_stop(local=True)
+
+    def publish(self, event):
+        if self.bus is not None:
+            self.bus.publish(event)
+
+    # splitter and hello go out in one write so the client can answer with its name right away
+    def on_connect(self, client):
+        self.log(f'{client.address[0]}:{client.address[1]} has connected, requesting name')
+        client.decoder = FrameDecoder(self.message_splitter, self.end_command, stop_type=self.binary_type)
+        self.rate_limiter.add(client)
+        if self.recorder is not None:
+            self.recorder.connect(client)
+        hello = f'{PROTOCOL_VERSION} {",".join(self.capabilities)} please submit your name before joining the chat.'
+        self.messages_out.inc()
+        self.engine.send(client, bytes(self.message_splitter + self.build_message(self.hello_type, hello), 'utf8'))
+        self.check_connection(client, time.monotonic())
+
+    def check_idle(self):
+        now = time.monotonic()
+        for client in self.idle_wheel.advance():
+            self.check_connection(client, now)
+        if self.running:
+            self.engine.call_later(self.idle_wheel.tick, self.check_idle)
+
+    # connections that never send a usable name or stop answering pings are closed instead of holding a socket forever,
+    # anything else goes back on the wheel for its next deadline
+    def check_connection(self, client, now):
+        if client.closed:
+            return
+        if client.state == 'hello' and now - client.connected_at >= self.handshake_timeout:
+            self.log(f'{client.address[0]}:{client.address[1]} did not register a name within {self.handshake_timeout} seconds')
+            self.drop_client(client)
+            return
+        if self.idle_timeout and client.heartbeat and now - client.last_received >= self.idle_timeout:
+            self.idle_disconnects.inc()
+            self.log(f'{client.address[0]}:{client.address[1]} ({client.name}) sent nothing for {self.idle_timeout} seconds, closing the connection')
+            self.drop_client(client)
+            return
+        if self.heartbeat_interval and client.heartbeat and now - max(client.last_received, client.pinged_at) >= self.heartbeat_interval:
+            self.send(client, self.ping_type, f'{now:.3f}')
+            client.pinged_at = now
+
+        deadlines = []
+        if client.state == 'hello':
+            deadlines.append(client.connected_at + self.handshake_timeout)
+        if self.idle_timeout and client.heartbeat:
+            deadlines.append(client.last_received + self.idle_timeout)
+        if self.heartbeat_interval and client.heartbeat:
+            deadlines.append(max(client.last_received, client.pinged_at) + self.heartbeat_interval)
+        if deadlines:
+            self.idle_wheel.schedule(client, min(deadlines) - now)
+
+    def on_data(self, client, data):
+        client.last_received = time.monotonic()
+        self.bytes_in.inc(len(data))
+        profile = 'admin' if self.permission_level(client) >= 1 else 'user'
+        wait = self.rate_limiter.consume(client, profile, 'bytes', len(data))
+        if wait and self.rate_limit_action == 'disconnect':
+            self.limit_client(client, wait)
+            return
+
+        try:
+            messages = client.decoder.feed(data)
+        except ValueError as e:
+            self.log(f'{client.address[0]}:{client.address[1]} {e}', self.error_event)
+            self.drop_client(client)
+            return
+
+        self.messages_in.inc(len(messages))
+        if wait and not self.limit_client(client, wait):
+            return
+
+        # frames still waiting for the message buckets go first, these queue up behind them
+        waiting = bool(client.held)
+        client.held.extend(messages)
+        if not waiting:
+            self.release_held(client, profile)
+
+    # frames are handled while the message buckets allow, the one that goes into debt included,
+    # the rest stays in client.held until the debt is paid off
+    def release_held(self, client, profile=None):
+        if profile is None:
+            profile = 'admin' if self.permission_level(client) >= 1 else 'user'
+        while client.held and not client.closed:
+            wait = self.rate_limiter.consume(client, profile, 'messages', 1)
+            self.handle_frames(client, [client.held.popleft()])
+            if wait:
+                if self.limit_client(client, wait) and client.held:
+                    self.engine.call_later(wait, self.release_held, client)
+                return
+
+    def handle_frames(self, client, messages):
+        for message_type, content in messages:
+            if self.recorder is not None:
+                self.recorder.frame(client, message_type, content)
+            if self.message_splitter in content:
+                # only a binary client can send it, copied into a text frame it would forge frames for everyone else
+                self.send(client, self.announcement_type, f'{self.error_event}the message contains the frame splitter and was dropped')
+            elif message_type == self.ping_type:
+                self.send(client, self.pong_type, content)
+                if not client.heartbeat:
+                    client.heartbeat = True
+                    self.check_connection(client, time.monotonic())
+            elif message_type == self.pong_type:
+                self.observe_pong(client)
+            elif message_type == self.binary_type and not client.binary:
+                self.switch_to_binary(client)
+            elif message_type == self.presence_type:
+                client.presence = True
+            elif client.state == 'hello' and message_type == self.resume_type:
+                after_seq, name, token, rooms = (content.split(' ', 3) + ['', '', ''])[:4]
+                self.register_client(client, name, int(after_seq) if after_seq.isdecimal() else None, rooms.split(), token)
+            elif client.state == 'hello':
+                self.register_client(client, content)
+            else:
+                self.handle_message(client, message_type, content)
+            if client.closed:
+                break
+
+    # the text decoder stopped at the binary frame, what the client sent after it is already binary
+    def switch_to_binary(self, client):
+        self.send(client, self.binary_type, 'ok')
+        client.binary = True
+        remainder = client.decoder.remainder()
+        client.decoder = BinaryDecoder()
+        if remainder:
+            try:
+                messages = client.decoder.feed(remainder)
+            except ValueError as e:
+                self.log(f'{client.address[0]}:{client.address[1]} {e}', self.error_event)
+                self.drop_client(client)
+                return
+            self.messages_in.inc(len(messages))
+            # the frames after the switch are next, still counted against the message buckets
+            client.held.extendleft(reversed(messages))
+
+    # timed from when the ping was sent, the content the client echoes is not trusted and a pong nobody asked for is ignored
+    def observe_pong(self, client):
+        if client.pinged_at:
+            self.ping_time.observe(time.monotonic() - client.pinged_at)
+            client.pinged_at = 0.0
+
+    # throttling stops reading from the client until its buckets refilled, the messages already read wait in client.held
+    # returns False when the client was disconnected instead
+    def limit_client(self, client, wait):
+        self.rate_limited.inc()
+        client.limited += 1
+        if self.rate_limit_action == 'disconnect':
+            self.log(f'{client.address[0]}:{client.address[1]} ({client.name}) disconnected for going over its rate limits', self.error_event)
+            self.send(client, self.announcement_type, f'{self.error_event}you are sending too fast')
+            self.drop_client(client)
+            return False
+
+        if client.limited == 1:
+            self.log(f'{client.address[0]}:{client.address[1]} ({client.name}) is over its rate limits and being throttled')
+            self.send(client, self.announcement_type, 'you are sending too fast, your messages are slowed down')
+        self.engine.pause_reading(client, wait)
+        return True
+
+    def register_client(self, client, name, after_seq=None, rooms=None, token=''):
+        # a client resuming with the token of the session replaces its old connection, which the server may not have noticed
+        # is dead yet, without the token the name is taken like any other
+        previous = self.sessions.get_by_name(name)
+        if after_seq is not None and previous is not None and token and hmac.compare_digest(previous.resume_token, token):
+            self.log(f'{client.address[0]}:{client.address[1]} resumed {name}, closing the old connection')
+            self.drop_client(previous)
+
+        # a joiner gets pending broadcasts from the history replay, not from the next flush as well
+        self.flush_broadcasts()
+
+        if name.strip() == '':
+            self.send(client, self.announcement_type, f'{self.error_event}the name can not be empty, choose another one')
+            return
+        # rosters and presence deltas are one name per line and commands split their arguments on spaces
+        if not name.isprintable() or any(character.isspace() for character in name):
+            self.send(client, self.announcement_type, f'{self.error_event}the name can not contain spaces or control characters, choose another one')
+            return
+
+        client.name = name
+        # a name taken on another worker is rejected too, two workers accepting the same name at once can still both win
+        # the client stays in the handshake and may try another name until the handshake timeout
+        if name in self.remote_names or not self.sessions.add(client):
+            self.send(client, self.announcement_type, f'{self.error_event}the name {name} is already taken, choose another one')
+            self.log(f'{client.address[0]}:{client.address[1]} tried to register taken name {name}')
+            client.name = None
+            return
+
+        client.state = 'joined'
+
+        client.resume_token = secrets.token_hex(16)
+        self.send(client, self.joined_type, f'{name} {client.resume_token}')
+        self.send(client, self.announcement_type, f'Welcome {name}! Send {{quit}} to exit.')
+
+        if client.address[0] in self.admins:
+            self.send(client, self.announcement_type, 'you are an admin')
+        if client.presence:
+            names = [session.name for session in self.sessions.snapshot()] + list(self.remote_names)
+            self.send(client, self.roster_type, '\n'.join(names))
+
+        # a resumed client is back in the rooms it had, without the joined the room lines
+        rooms = [room for room in rooms or () if len(room) <= 32] or [self.default_room]
+        for room in rooms:
+            self.rooms.join(client, room)
+        client.room = rooms[0]
+        self.send_rooms(client)
+        self.send_history(client, after_seq)
+        self.publish({'event': 'join', 'name': name})
+        self.presence_change(name, True)
+
+        self.handshake_time.observe(time.monotonic() - client.connected_at)
+        self.log(f'{client.address[0]}:{client.address[1]} registered name {name}')
+
+    def handle_message(self, client, message_type, content):
+        name = client.name
+
+        if message_type == self.text_type:
+            if content != '{quit}':
+                words = content.split()
+                if words and words[0] in self.commands:
+                    if self.permission_level(client) >= self.commands[words[0]].permission:
+                        self.handle_command(content, client)
+                    else:
+                        self.send(client, self.announcement_type, 'You are not allowed to use commands in this chat!')
+                elif client.room is None:
+                    self.send(client, self.announcement_type, 'join a room with !join <room> to talk')
+                else:
+                    self.broadcast(self.room_type, f'{client.room} {name}: ' + content, client.room)
+            else:
+                self.drop_client(client)
+
+    def drop_client(self, client):
+        if client.closed:
+            return
+        self.idle_wheel.cancel(client)
+        if self.recorder is not None:
+            self.recorder.close(client)
+        self.engine.close(client)
+        self.rate_limiter.remove(client)
+        self.rooms.leave_all(client)
+        if self.sessions.remove(client):
+            self.log(f'{client.name} disconnected.')
+            self.publish({'event': 'leave', 'name': client.name})
+            self.presence_change(client.name, False)
+
+    def send(self, client, message_type, content):
+        self.messages_out.inc()
+        if client.binary:
+            self.engine.send(client, encode_binary(message_type, str(content).encode('utf8')))
+        else:
+            self.engine.send(client, bytes(self.build_message(message_type, content), 'utf8'))
+
+    # room None reaches every client, otherwise only the subscribers of that room
+    def broadcast(self, message_type, content, room=None):
+        self.deliver(message_type, content, room)
+        self.publish({'event': 'broadcast', 'type': message_type, 'content': content, 'room': room})
+
+    # sends to the clients of this process only
+    def deliver(self, message_type, content, room=None):
+        seq = self.history.append(self.message_types.index(message_type), content)
+        self.index_message(seq, time.time(), message_type, content)
+        # encoded once per framing, every recipient gets one of the same two buffers
+        data = bytes(self.build_message(self.seq_type, seq) + self.build_message(message_type, content), 'utf8')
+        binary_data = encode_binary(message_type, content.encode('utf8'), seq)
+        if self.coalesce_window > 0:
+            # everything broadcast within one window reaches each recipient as a single buffer
+            if not self.coalesced:
+                self.engine.call_later(self.coalesce_window, self.flush_broadcasts)
+            if self.coalesced[-1:] and self.coalesced[-1][0] == room:
+                self.coalesced[-1][1].append(data)
+                self.coalesced[-1][2].append(binary_data)
+            else:
+                self.coalesced.append([room, [data], [binary_data]])
+            return
+        self.fan_out(room, data, binary_data, 1)
+
+    def flush_broadcasts(self):
+        runs = self.coalesced
+        self.coalesced = []
+        if len(runs) == 1:
+            room, parts, binary_parts = runs[0]
+            self.fan_out(room, b''.join(parts), b''.join(binary_parts), len(parts))
+        elif runs:
+            self.fan_out_runs(runs)
+
+    # broadcasts to several rooms keep their sequence order, each recipient gets the runs it is subscribed to as one buffer
+    def fan_out_runs(self, runs):
+        started = time.perf_counter()
+        buffers = {}
+        count = 0
+        for room, parts, binary_parts in runs:
+            data = b''.join(parts)
+            binary_data = b''.join(binary_parts)
+            sessions = self.sessions.snapshot() if room is None else self.rooms.subscribers(room)
+            for session in sessions:
+                buffers.setdefault(session, []).append(binary_data if session.binary else data)
+            count += len(sessions) * len(parts)
+        for session, data in buffers.items():
+            self.engine.send(session, b''.join(data))
+        self.messages_out.inc(count)
+        self.broadcast_time.observe(time.perf_counter() - started)
+
+    def fan_out(self, room, data, binary_data, count):
+        started = time.perf_counter()
+        sessions = self.sessions.snapshot() if room is None else self.rooms.subscribers(room)
+        for session in sessions:
+            self.engine.send(session, binary_data if session.binary else data)
+        self.messages_out.inc(len(sessions) * count)
+        self.broadcast_time.observe(time.perf_counter() - started)
+
+    # joins and leaves go out at most once per presence interval, a reconnect storm costs each client one write per interval
+    def presence_change(self, name, joined):
+        # only the last change of a name within one interval goes out, a roster sent in between may already have it
+        self.presence_changes.pop(name, None)
+        self.presence_changes[name] = joined
+        if not self.presence_flush_scheduled:
+            self.presence_flush_scheduled = True
+            self.engine.call_later(self.presence_interval, self.flush_presence)
+
+    def flush_presence(self):
+        self.presence_flush_scheduled = False
+        changes = self.presence_changes
+        self.presence_changes = {}
+        if not changes:
+            return
+
+        delta = '\n'.join(('+' if joined else '-') + name for name, joined in changes.items())
+        # clients without presence still get the announcements, batched into one buffer per framing
+        announcements = [f'{name}  joined!' if joined else f'{name} left.' for name, joined in changes.items()]
+        data = b''.join(bytes(self.build_message(self.announcement_type, announcement), 'utf8') for announcement in announcements)
+        binary_data = b''.join(encode_binary(self.announcement_type, announcement.encode('utf8')) for announcement in announcements)
+        for session in self.sessions.snapshot():
+            if session.presence:
+                self.send(session, self.presence_type, delta)
+            else:
+                self.messages_out.inc(len(announcements))
+                self.engine.send(session, binary_data if session.binary else data)
+
+    # room lines are indexed without their room and author prefix, everything else counts as said by the server
+    def index_message(self, seq, timestamp, message_type, content):
+        author = ''
+        if message_type == self.room_type:
+            line = content.partition(' ')[2]
+            name, separator, text = line.partition(': ')
+            if separator:
+                author, content = name, text
+        self.search_index.add(seq, timestamp, author, content)
+
+    def send_rooms(self, client):
+        rooms = [client.room] + sorted(client.rooms - {client.room}) if client.room is not None else []
+        self.send(client, self.rooms_type, ' '.join(rooms))
+
+    # sends the history after after_seq, or the last history_replay messages, as one write
+    # a gap longer than history_resume_limit is cut to its newest messages, room lines only of the client's rooms
+    def send_history(self, client, after_seq=None):
+        if after_seq is None:
+            # joiners between two broadcasts share one encoded replay
+            if self.replay_cache[client.binary][0] != self.history.next_seq:
+                self.replay_cache[client.binary] = (self.history.next_seq, self.encode_history(self.history.tail(self.history_replay), client.binary))
+            data = self.replay_cache[client.binary][1]
+        else:
+            after_seq = max(after_seq, self.history.next_seq - 1 - self.history_resume_limit)
+            data = self.encode_history(self.history.read_since(after_seq), client.binary, client.rooms)
+
+        if data:
+            self.messages_out.inc()
+            self.engine.send(client, data)
+
+    def encode_history(self, records, binary=False, rooms=None):
+        splitter = self.message_splitter.encode('utf8')
+        end = splitter + self.end_command.encode('utf8') + splitter
+        seq_start = self.seq_type.encode('utf8') + splitter
+        types = [message_type.encode('utf8') + splitter for message_type in self.message_types]
+        # joiners start in the default room, lines from other rooms are left out of the replay
+        room_index = self.message_types.index(self.room_type)
+        room_prefixes = [f'{room} '.encode('utf8') for room in rooms or (self.default_room,)]
+        type_codes = [BINARY_TYPE_CODES[message_type] for message_type in self.message_types]
+        # the replay is queued as one buffer, it keeps the newest messages that fit in half the queue limit
+        # so the joiner is not dropped as a slow consumer and live broadcasts still fit behind it
+        budget = self.max_queue_bytes // 2
+        parts = []
+        for seq, _, message_type, payload in reversed(records):
+            if message_type == room_index and not any(payload[:len(prefix)] == prefix for prefix in room_prefixes):
+                continue
+            if binary:
+                # the payload goes from the history segment into the joined buffer as it is
+                record = [payload, BINARY_HEADER.pack(len(payload), type_codes[message_type], seq)]
+            else:
+                record = [end, payload, types[message_type], seq_start + str(seq).encode('utf8') + end]
+            budget -= sum(len(part) for part in record)
+            if budget < 0:
+                break
+            parts.extend(record)
+        parts.reverse()
+        return b''.join(parts)
+
+    def build_message(self, type, content):
+        if type in self.frame_types:
+            message = f'{type}{self.message_splitter}{content}{self.message_splitter}{self.end_command}{self.message_splitter}'
+            return message
+
+    # text is a line or a list of lines, the writer thread of the log pipeline formats them
+    def log(self, text, event=''):
+        self.log_pipeline.push(self.log_prefix + event, text)
+
+    def register_command(self, name, usage, handler, permission=1):
+        self.commands[name] = Command(name, usage, handler, permission)
+
+    def permission_level(self, client):
+        return self.admins.get(client.address[0], 0)
+
+    def reply(self, client, text, event=''):
+        if client is None:
+            self.log(text, event)
+        else:
+            self.send(client, self.announcement_type, event + text)
+
+    def handle_command(self, raw_command, client=None):
+        command = raw_command.split()
+        entry = self.commands.get(command[0]) if command else None
+        if entry is None:
+            self.reply(client, 'this is not a supported command!', self.error_event)
+            return
+
+        if client is not None:
+            self.log(f'{client.name} used: {raw_command}')
+        entry.handler(entry, command[1:], client)
+
+    def command_broadcast(self, entry, args, client):
+        if len(args) > 0:
+            message = ''.join(c + ' ' for c in args)
+            self.broadcast(self.announcement_type, message)
+            if client is None:
+                self.log(f'{entry.name} {message}')
+        else:
+            self.reply(client, entry.usage, self.usage_error_event)
+
+    def command_getinfo(self, entry, args, client):
+        if len(args) != 1:
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        session = self.sessions.get_by_name(args[0])
+        if session is None:
+            self.reply(client, 'no user with this name found', self.error_event)
+            return
+
+        is_admin = session.address[0] in self.admins
+        text = f'address: {session.address}, is admin: {is_admin}, rooms: {", ".join(sorted(session.rooms))}, rate limited: {session.limited} times, queued: {len(session.outbound)} messages / {session.outbound_bytes} bytes'
+        self.reply(client, text, self.user_info_event if client is None else '')
+
+    def command_setop(self, entry, args, client):
+        if len(args) != 1:
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        session = self.sessions.get_by_name(args[0])
+        if session is None and args[0] in self.remote_names:
+            # the worker holding the connection knows its address
+            self.publish({'event': 'setop', 'name': args[0]})
+            self.reply(client, f'asked the worker of {args[0]} to add them to the admins')
+            return
+        if session is None:
+            self.reply(client, 'no user with this name found', self.error_event)
+            return
+
+        ip = session.address[0]
+        if self.admins.get(ip) == 1:
+            self.reply(client, f'{args[0]} is already an admin')
+        else:
+            text = f'added {args[0]} back to the admins' if ip in self.admins else f'added {args[0]} to the admins'
+            self.admins.set(ip, 1)
+            self.publish({'event': 'admin', 'ip': ip, 'level': 1})
+            self.send(session, self.announcement_type, 'you are now an admin')
+            self.reply(client, text)
+
+    def command_help(self, entry, args, client):
+        if len(args) == 0:
+            lines = [f'command: {c.name}, usage: {c.usage}' for c in self.commands.values()]
+            if client is None:
+                self.log(lines)
+            else:
+                for line in lines:
+                    self.reply(client, line)
+        elif len(args) == 1:
+            c = self.commands.get(args[0])
+            if c is None:
+                self.reply(client, 'no command with this name found', self.error_event)
+            else:
+                self.reply(client, f'command: {c.name}, usage: {c.usage}')
+        else:
+            self.reply(client, entry.usage, self.usage_error_event)
+
+    def command_stats(self, entry, args, client):
+        if len(args) != 0:
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        queues = self.engine.queue_metrics()
+        lines = [
+            f'connected clients: {len(self.sessions)}',
+            f'messages in/out per second: {self.messages_in.rate:.1f} / {self.messages_out.rate:.1f}',
+            f'bytes in/out per second: {self.bytes_in.rate:.0f} / {self.bytes_out.rate:.0f}',
+            f'socket writes per second: {self.write_calls.rate:.0f}',
+            f'broadcast fan-out p50/p99: {self.broadcast_time.quantile(0.5) * 1000:.2f} / {self.broadcast_time.quantile(0.99) * 1000:.2f} ms',
+            f'handshake p50/p99: {self.handshake_time.quantile(0.5) * 1000:.0f} / {self.handshake_time.quantile(0.99) * 1000:.0f} ms',
+            f'ping p50/p99: {self.ping_time.quantile(0.5) * 1000:.0f} / {self.ping_time.quantile(0.99) * 1000:.0f} ms, idle disconnects: {self.idle_disconnects.value}',
+            f'queued: {queues["queued_bytes"]} bytes, deepest queue: {queues["max_queue_depth"]} messages',
+            f'dropped messages: {queues["dropped_messages"]}, slow consumer disconnects: {queues["slow_consumer_disconnects"]}',
+            f'rate limited: {self.rate_limiter.limited} times, most by: ' + (', '.join(f'{ip} ({count})' for ip, count in self.rate_limiter.limited_by_ip.most_common(3)) or 'nobody')
+        ]
+        if client is None:
+            self.log(lines)
+        else:
+            for line in lines:
+                self.reply(client, line)
+
+    def command_join(self, entry, args, client):
+        if client is None:
+            self.reply(client, 'only clients can join rooms', self.error_event)
+            return
+        if len(args) != 1 or len(args[0]) > 32:
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        room = args[0]
+        if self.rooms.join(client, room):
+            self.broadcast(self.room_type, f'{room} {client.name} joined the room', room)
+        client.room = room
+        self.send_rooms(client)
+        self.reply(client, f'you are now talking in {room}')
+
+    def command_leave(self, entry, args, client):
+        if client is None:
+            self.reply(client, 'only clients can leave rooms', self.error_event)
+            return
+        if len(args) > 1 or (len(args) == 0 and client.room is None):
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        room = args[0] if args else client.room
+        if not self.rooms.leave(client, room):
+            self.reply(client, f'you are not in {room}', self.error_event)
+            return
+
+        self.broadcast(self.room_type, f'{room} {client.name} left the room', room)
+        if client.room == room:
+            client.room = min(client.rooms) if client.rooms else None
+        self.send_rooms(client)
+        if client.room is None:
+            self.reply(client, f'you left {room}, join a room with !join <room> to talk')
+        else:
+            self.reply(client, f'you left {room}, now talking in {client.room}')
+
+    def command_rooms(self, entry, args, client):
+        if len(args) != 0:
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        counts = self.rooms.counts()
+        if not counts:
+            self.reply(client, 'there are no rooms')
+            return
+
+        for room in sorted(counts):
+            marker = '* ' if client is not None and room == client.room else ''
+            self.reply(client, f'{marker}{room}: {counts[room]} members')
+
+    def command_stop(self, entry, args, client):
+        if len(args) == 0:
+            self.request_stop()
+            self.log('Server stopped')
+        elif len(args) == 1 and args[0].isdecimal():
+            self.shutdown_timer = int(args[0])
+            if not self.shutdown_countdown:
+                self.shutdown_countdown = True
+                self.engine.call_later(1, self.count_down_shutdown)
+            self.log(f'Server will shutdown in {self.shutdown_timer} seconds')
+            self.broadcast(self.announcement_type, f'Server will shutdown in {self.shutdown_timer} seconds')
+        else:
+            self.reply(client, entry.usage, self.usage_error_event)
+
+    def command_profile(self, entry, args, client):
+        if len(args) == 0 or args[0] not in ('start', 'stop') or len(args) > 2 or (args[0] == 'stop' and len(args) > 1):
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        if args[0] == 'start':
+            mode = args[1] if len(args) > 1 else 'sample'
+            if self.profiler is not None:
+                self.reply(client, 'the profiler is already running', self.error_event)
+            elif mode == 'sample':
+                # covers every thread, the selector loop as well as the reader and writer threads of the threaded engine
+                self.profiler = StackSampler()
+                self.profiler.start()
+                self.reply(client, 'sampling profiler started')
+            elif mode == 'cprofile':
+                # cProfile only sees the thread that enabled it, commands run on the loop thread in selector mode
+                if self.network_mode != 'selector':
+                    self.reply(client, f'cprofile only covers the loop thread of selector mode, use sample in {self.network_mode} mode', self.error_event)
+                    return
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+                self.reply(client, 'cprofile started')
+            else:
+                self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        if self.profiler is None:
+            self.reply(client, 'the profiler is not running', self.error_event)
+            return
+        profiler, self.profiler = self.profiler, None
+        if isinstance(profiler, StackSampler):
+            profiler.stop()
+            path = self.dump_path('profile', 'collapsed.txt')
+            profiler.dump(path)
+            top = [f'{samples} samples: {frame}' for frame, samples in profiler.top(5)]
+        else:
+            profiler.disable()
+            path = self.dump_path('profile', 'pstats')
+            profiler.dump_stats(path)
+            stats = pstats.Stats(profiler)
+            top = [f'{stats.stats[function][3] * 1000:.1f} ms: {pstats.func_std_string(function)}' for function in sorted(stats.stats, key=lambda function: -stats.stats[function][3])[:5]]
+        self.reply(client, f'profile written to {path}')
+        for line in top:
+            self.reply(client, line)
+
+    def command_memtrace(self, entry, args, client):
+        if len(args) != 1 or args[0] not in ('start', 'stop'):
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        if args[0] == 'start':
+            if tracemalloc.is_tracing():
+                self.reply(client, 'memory tracing is already running', self.error_event)
+                return
+            tracemalloc.start(25)
+            self.reply(client, 'memory tracing started')
+            return
+
+        if not tracemalloc.is_tracing():
+            self.reply(client, 'memory tracing is not running', self.error_event)
+            return
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        path = self.dump_path('memtrace', 'snapshot')
+        snapshot.dump(path)
+        self.reply(client, f'memory snapshot written to {path}, load it with tracemalloc.Snapshot.load')
+        for statistic in snapshot.statistics('lineno')[:5]:
+            self.reply(client, str(statistic))
+
+    def command_record(self, entry, args, client):
+        if len(args) != 1 or args[0] not in ('start', 'stop'):
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        if args[0] == 'start':
+            if self.recorder is not None:
+                self.reply(client, 'the recorder is already running', self.error_event)
+                return
+            self.recorder = TraceWriter(self.dump_path('trace', 'bin'))
+            self.reply(client, f'recording inbound frames to {self.recorder.path}')
+            return
+
+        if self.recorder is None:
+            self.reply(client, 'the recorder is not running', self.error_event)
+            return
+        recorder, self.recorder = self.recorder, None
+        recorder.stop()
+        self.reply(client, f'recorded {recorder.frames} frames from {recorder.next_id} connections to {recorder.path}, replay it with replay.py')
+
+    def command_search(self, entry, args, client):
+        terms = [arg for arg in args if not arg.startswith('from:')]
+        authors = [arg[len('from:'):] for arg in args if arg.startswith('from:')]
+        if len(terms) == 0 or len(authors) > 1:
+            self.reply(client, entry.usage, self.usage_error_event)
+            return
+
+        started = time.perf_counter()
+        matches = self.search_index.search(terms, self.search_results, authors[0] if authors else None)
+        elapsed = (time.perf_counter() - started) * 1000
+        lines = [f'{len(matches)} newest matches for {" ".join(args)} in {elapsed:.1f} ms']
+        for seq, timestamp, author in matches:
+            stamp = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+            # the text comes from the history, which may already have dropped old segments
+            records = self.history.read_since(seq - 1, 1)
+            if not records or records[0][0] != seq:
+                lines.append(f'#{seq} {stamp} {author or "server"}: (no longer in the history)')
+            elif self.message_types[records[0][2]] == self.room_type:
+                room, _, line = str(records[0][3], 'utf8').partition(' ')
+                lines.append(f'#{seq} {stamp} [{room}] {line}')
+            else:
+                lines.append(f'#{seq} {stamp} {str(records[0][3], "utf8")}')
+        if client is None:
+            self.log(lines)
+        else:
+            for line in lines:
+                self.reply(client, line)
+
+    # profile_dir/<kind>_<time><worker suffix>.<extension>
+    def dump_path(self, kind, extension):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.profile_dir, f'{kind}_{stamp}{self.worker_suffix}.{extension}')
+
+    def add_line(self, line):
+        self.screen_text.append(line)
+        for listener in self.log_listeners:
+            listener(line)
@@ -0,0 +1,37 @@
+import threading
+
+
+# registered clients indexed by name and connection, both maps change together under one lock
+class SessionRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_name = {}
+        self.by_connection = {}
+
+    def __len__(self):
+        return len(self.by_connection)
+
+    def __contains__(self, connection):
+        return connection in self.by_connection
+
+    def add(self, connection):
+        with self.lock:
+            if connection.name in self.by_name:
+                return False
+            self.by_name[connection.name] = connection
+            self.by_connection[connection] = connection
+            return True
+
+    def remove(self, connection):
+        with self.lock:
+            if self.by_connection.pop(connection, None) is None:
+                return False
+            del self.by_name[connection.name]
+            return True
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.by_connection)
@@ -0,0 +1,65 @@
+import json
+from admin_store import AdminStore
+
+
+def write_store(tmp_path, snapshot, journal):
+    path = str(tmp_path / 'admins.json')
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(snapshot, f)
+    with open(path + '.journal', 'wb') as f:
+        f.write(journal)
+    return path
+
+
+def journal_line(ip, level):
+    return (json.dumps({'ip': ip, 'level': level}) + '\n').encode('utf8')
+
+
+def test_partial_last_line_is_cut_off(tmp_path):
+    valid = journal_line('10.0.0.1', 1) + journal_line('10.0.0.2', 1)
+    path = write_store(tmp_path, {}, valid + b'{"ip": "10.0.0.3", "le')
+
+    store = AdminStore(path)
+    assert store.levels == {'10.0.0.1': 1, '10.0.0.2': 1}
+    with open(path + '.journal', 'rb') as f:
+        assert f.read() == valid
+
+    # the next change starts on a line of its own and survives a crash, closing the journal without compacting
+    store.set('10.0.0.4', 1)
+    store.journal.close()
+    assert AdminStore(path).levels == {'10.0.0.1': 1, '10.0.0.2': 1, '10.0.0.4': 1}
+
+
+def test_complete_json_without_newline_counts_as_torn(tmp_path):
+    path = write_store(tmp_path, {}, journal_line('10.0.0.1', 1) + journal_line('10.0.0.2', 1)[:-1])
+    assert AdminStore(path, persist=False).levels == {'10.0.0.1': 1}
+
+
+def test_journal_already_in_the_snapshot_changes_nothing(tmp_path):
+    # a crash after the snapshot was renamed in but before the journal was emptied
+    snapshot = {'10.0.0.1': 1, '10.0.0.2': 0}
+    path = write_store(tmp_path, snapshot, journal_line('10.0.0.1', 1) + journal_line('10.0.0.2', 0))
+    assert AdminStore(path, persist=False).levels == snapshot
+
+
+def test_compaction_and_reopen(tmp_path):
+    path = write_store(tmp_path, {}, b'')
+    store = AdminStore(path, compact_after=3)
+    for i in range(5):
+        store.set(f'10.0.0.{i}', 1)
+    expected = {f'10.0.0.{i}': 1 for i in range(5)}
+
+    # three changes went into the snapshot, two are still journaled
+    with open(path, 'r', encoding='utf8') as f:
+        assert json.load(f) == {f'10.0.0.{i}': 1 for i in range(3)}
+    with open(path + '.journal', 'rb') as f:
+        assert f.read() == journal_line('10.0.0.3', 1) + journal_line('10.0.0.4', 1)
+    assert AdminStore(path, persist=False).levels == expected
+
+    # closing compacts the rest and leaves an empty journal
+    store.close()
+    with open(path, 'r', encoding='utf8') as f:
+        assert json.load(f) == expected
+    with open(path + '.journal', 'rb') as f:
+        assert f.read() == b''
+    assert AdminStore(path).levels == expected
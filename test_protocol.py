@@ -0,0 +1,161 @@
+import random
+import pytest
+from protocol import FrameDecoder, BinaryDecoder, encode_binary, BINARY_HEADER, BINARY_TYPES, BINARY_TYPE_CODES
+
+
+SPLITTER = 'a1b2c3d4e5'
+# multi byte utf8, so read boundaries land inside characters, and a prefix of the splitter that must not match
+CONTENTS = ['hello', '', 'grüße', '日本語のテキスト', 'emoji 🎉🎉', 'x' * 1000, 'end', 'a1b2c3d4e ']
+
+
+def encode_text(message_type, content, splitter=SPLITTER):
+    return f'{message_type}{splitter}{content}{splitter}end{splitter}'.encode('utf8')
+
+
+def random_frames(rng, count):
+    return [(rng.choice(['text', 'announcement', 'room']), rng.choice(CONTENTS) + str(i)) for i in range(count)]
+
+
+# cuts data at random offsets, single bytes included
+def random_chunks(rng, data):
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.choice([1, 1, 2, 3, rng.randint(1, 64), rng.randint(1, 4096)])
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+def feed_all(decoder, chunks):
+    messages = []
+    for chunk in chunks:
+        messages.extend(decoder.feed(chunk))
+    return messages
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_text_random_read_boundaries(seed):
+    rng = random.Random(seed)
+    frames = random_frames(rng, 200)
+    data = b''.join(encode_text(*frame) for frame in frames)
+    assert feed_all(FrameDecoder(SPLITTER), random_chunks(rng, data)) == frames
+
+
+def test_text_utf8_split_at_every_offset():
+    content = 'ä日🎉'
+    data = encode_text('text', content)
+    for cut in range(1, len(data)):
+        decoder = FrameDecoder(SPLITTER)
+        assert decoder.feed(data[:cut]) + decoder.feed(data[cut:]) == [('text', content)]
+
+
+def test_text_splitter_split_at_every_offset():
+    data = encode_text('text', 'one') + encode_text('text', 'two')
+    for cut in range(1, len(data)):
+        decoder = FrameDecoder(SPLITTER)
+        assert decoder.feed(data[:cut]) + decoder.feed(data[cut:]) == [('text', 'one'), ('text', 'two')]
+
+
+def test_text_resyncs_after_missing_end():
+    data = f'text{SPLITTER}lost{SPLITTER}'.encode('utf8') + encode_text('text', 'one') + encode_text('room', 'two')
+    assert FrameDecoder(SPLITTER).feed(data)[-2:] == [('text', 'one'), ('room', 'two')]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_text_resyncs_after_missing_end_random_boundaries(seed):
+    rng = random.Random(seed)
+    frames = random_frames(rng, 50)
+    data = f'text{SPLITTER}lost{SPLITTER}'.encode('utf8') + b''.join(encode_text(*frame) for frame in frames)
+    assert feed_all(FrameDecoder(SPLITTER), random_chunks(rng, data))[-len(frames) + 1:] == frames[1:]
+
+
+def test_text_max_size():
+    decoder = FrameDecoder(SPLITTER, max_size=100)
+    assert decoder.feed(encode_text('text', 'x' * 50)) == [('text', 'x' * 50)]
+    with pytest.raises(ValueError):
+        decoder.feed(b'x' * 101)
+
+
+def test_text_max_size_split_frame():
+    decoder = FrameDecoder(SPLITTER, max_size=100)
+    data = encode_text('text', 'x' * 200)
+    decoder.feed(data[:90])
+    with pytest.raises(ValueError):
+        decoder.feed(data[90:120])
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_stop_type_leaves_the_rest(seed):
+    rng = random.Random(seed)
+    before = random_frames(rng, 20)
+    after = [(BINARY_TYPES[i % len(BINARY_TYPES)], f'after {i} 🎉') for i in range(20)]
+    data = b''.join(encode_text(*frame) for frame in before) + encode_text('binary', 'on')
+    data += b''.join(encode_binary(message_type, content.encode('utf8'), i) for i, (message_type, content) in enumerate(after))
+
+    decoder = FrameDecoder(SPLITTER, stop_type='binary')
+    messages = []
+    chunks = random_chunks(rng, data)
+    consumed = 0
+    for chunk in chunks:
+        messages.extend(decoder.feed(chunk))
+        consumed += len(chunk)
+        if messages and messages[-1][0] == 'binary':
+            break
+    assert messages == before + [('binary', 'on')]
+
+    # whatever was read after the binary frame continues in a binary decoder
+    rest = decoder.remainder() + data[consumed:]
+    assert feed_all(BinaryDecoder(), random_chunks(rng, rest)) == after
+
+
+def test_remainder_empties_the_buffer():
+    decoder = FrameDecoder(SPLITTER, stop_type='binary')
+    assert decoder.feed(encode_text('binary', 'on') + b'\x01\x02\x03') == [('binary', 'on')]
+    assert decoder.remainder() == b'\x01\x02\x03'
+    assert decoder.remainder() == b''
+
+
+def random_binary_frames(rng, count):
+    return [(rng.choice(BINARY_TYPES), rng.randint(0, 2 ** 40), (rng.choice(CONTENTS) + str(i)).encode('utf8')) for i in range(count)]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_binary_random_read_boundaries(seed):
+    rng = random.Random(seed)
+    frames = random_binary_frames(rng, 200)
+    data = b''.join(encode_binary(message_type, payload, seq) for message_type, seq, payload in frames)
+
+    decoder = BinaryDecoder()
+    decoded = []
+    for chunk in random_chunks(rng, data):
+        decoded.extend((message_type, seq, bytes(payload)) for message_type, seq, payload in decoder.frames(chunk))
+    assert decoded == frames
+    assert decoder.pending == b''
+
+
+def test_binary_utf8_split_at_every_offset():
+    content = 'ä日🎉'
+    data = encode_binary('text', content.encode('utf8'), 7)
+    for cut in range(1, len(data)):
+        decoder = BinaryDecoder()
+        assert decoder.feed(data[:cut]) + decoder.feed(data[cut:]) == [('text', content)]
+
+
+def test_binary_max_size():
+    decoder = BinaryDecoder(max_size=100)
+    assert decoder.feed(encode_binary('text', b'x' * 100)) == [('text', 'x' * 100)]
+    with pytest.raises(ValueError):
+        # the header alone is enough to refuse the frame
+        decoder.feed(encode_binary('text', b'x' * 101)[:BINARY_HEADER.size])
+
+
+def test_binary_unknown_type():
+    with pytest.raises(ValueError):
+        BinaryDecoder().feed(BINARY_HEADER.pack(1, len(BINARY_TYPES), 0) + b'x')
+
+
+def test_binary_type_codes_are_stable():
+    # codes are on the wire, new types may only be appended
+    assert BINARY_TYPE_CODES['text'] == 0
+    assert BINARY_TYPE_CODES['binary'] == 8
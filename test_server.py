@@ -0,0 +1,230 @@
+import shutil
+import socket
+import time
+import urllib.request
+import pytest
+from benchmark import spawn_server
+from protocol import FrameDecoder, BinaryDecoder, encode_binary, SPLITTER_LENGTH
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# a headless server on a free port with the checkout's config, stopped again after the test
+# tests pass config overrides with @pytest.mark.parametrize('server', [{...}], indirect=True)
+@pytest.fixture
+def server(request):
+    port = free_port()
+    process, run_directory = spawn_server('selector', port, 'data/config.json', 1, overrides=getattr(request, 'param', None))
+    yield port
+    if process.poll() is None:
+        process.stdin.write('!stop\n')
+        process.stdin.flush()
+    process.wait(timeout=10)
+    shutil.rmtree(run_directory, ignore_errors=True)
+
+
+class ChatClient:
+    def __init__(self, port, binary=False):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        data = b''
+        while len(data) < SPLITTER_LENGTH:
+            data += self.sock.recv(65536)
+        self.splitter = data[:SPLITTER_LENGTH].decode('utf8')
+        self.decoder = FrameDecoder(self.splitter, stop_type='binary')
+        self.frames = self.decoder.feed(data[SPLITTER_LENGTH:])
+        self.closed = False
+        self.binary = False
+        if binary:
+            self.send('binary', 'on')
+            self.binary = True
+            self.wait_for(lambda message_type, content: message_type == 'binary')
+
+    def send(self, message_type, content):
+        if self.binary:
+            self.sock.sendall(encode_binary(message_type, content.encode('utf8')))
+        else:
+            self.sock.sendall(f'{message_type}{self.splitter}{content}{self.splitter}end{self.splitter}'.encode('utf8'))
+
+    def receive(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(1 << 20)
+        except socket.timeout:
+            return False
+        except OSError:
+            data = b''
+        if not data:
+            self.closed = True
+            return False
+        for frame in self.decoder.feed(data):
+            self.frames.append(frame)
+            if frame[0] == 'binary' and isinstance(self.decoder, FrameDecoder):
+                remainder = self.decoder.remainder()
+                self.decoder = BinaryDecoder()
+                self.frames.extend(self.decoder.feed(remainder))
+        return True
+
+    # frames until the connection was quiet for quiet seconds
+    def drain(self, quiet=0.3):
+        while self.receive(quiet):
+            pass
+        frames, self.frames = self.frames, []
+        return frames
+
+    # frames received within the next seconds
+    def collect(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and self.receive(deadline - time.monotonic()):
+            pass
+        frames, self.frames = self.frames, []
+        return frames
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while True:
+            for index, frame in enumerate(self.frames):
+                if predicate(*frame):
+                    del self.frames[:index + 1]
+                    return frame
+            remaining = deadline - time.monotonic()
+            if self.closed or remaining <= 0:
+                raise AssertionError(f'no matching frame, got {self.frames}')
+            self.receive(remaining)
+
+    def join(self, name):
+        self.send('text', name)
+        return self.wait_for(lambda message_type, content: message_type == 'joined')
+
+
+def test_binary_client_can_not_forge_frames(server):
+    watcher = ChatClient(server)
+    watcher.join('watcher')
+    attacker = ChatClient(server, binary=True)
+    attacker.join('attacker')
+    watcher.drain()
+
+    splitter = watcher.splitter
+    attacker.send('text', f'hi{splitter}end{splitter}announcement{splitter}you are an admin{splitter}end{splitter}seq{splitter}999999')
+    attacker.send('text', 'plain line')
+    frames = watcher.drain()
+
+    assert [frame for frame in frames if frame[0] == 'room'] == [('room', 'lobby attacker: plain line')]
+    assert ('announcement', 'you are an admin') not in frames
+    assert ('seq', '999999') not in frames
+    assert any('frame splitter' in content for _, content in attacker.drain())
+
+
+def test_history_larger_than_the_queue_limit_is_replayed_cut(server):
+    writer = ChatClient(server)
+    writer.join('writer')
+    line = 'x' * 30000
+    for _ in range(50):
+        writer.send('text', line)
+        writer.wait_for(lambda message_type, content: message_type == 'room' and content.endswith(line))
+
+    joiner = ChatClient(server)
+    joiner.join('joiner')
+    joiner.send('text', '!rooms')
+    frames = joiner.drain()
+    assert not joiner.closed
+    assert ('announcement', '* lobby: 2 members') in frames
+    replayed = [content for message_type, content in frames if message_type == 'room' and content.endswith(line)]
+    # the newest lines up to half of max_queue_bytes
+    assert 10 <= len(replayed) < 50
+
+
+def test_resume_needs_the_token_of_the_session(server):
+    victim = ChatClient(server)
+    name, token = victim.join('victim')[1].split(' ')
+    assert name == 'victim' and len(token) == 32
+
+    wrong_token = token[:-1] + ('1' if token[-1] == '0' else '0')
+    for content in ('0 victim', '0 victim secret', f'0 victim {wrong_token} lobby'):
+        thief = ChatClient(server)
+        thief.send('resume', content)
+        frames = thief.drain()
+        assert ('announcement', 'ERROR: the name victim is already taken, choose another one') in frames
+        assert not any(message_type == 'joined' for message_type, _ in frames)
+    victim.send('text', 'still here')
+    victim.wait_for(lambda message_type, content: content == 'lobby victim: still here')
+
+    # the real client coming back after a drop takes the session over and gets a new token
+    returning = ChatClient(server)
+    returning.send('resume', f'0 victim {token} lobby')
+    new_name, new_token = returning.wait_for(lambda message_type, content: message_type == 'joined')[1].split(' ')
+    assert new_name == 'victim' and new_token != token
+    victim.drain()
+    assert victim.closed
+
+
+def test_repeated_stop_keeps_one_countdown(server):
+    admin = ChatClient(server)
+    admin.join('admin')
+    started = time.monotonic()
+    for _ in range(3):
+        admin.send('text', '!stop 3')
+    admin.wait_for(lambda message_type, content: content == 'Server stopped', timeout=10)
+    assert time.monotonic() - started >= 2.5
+
+
+@pytest.mark.parametrize('server', [{'heartbeat_interval': 1, 'idle_timeout': 2}], indirect=True)
+def test_only_clients_that_ping_are_pinged_and_reaped(server):
+    legacy = ChatClient(server)
+    legacy.join('legacy')
+    silent = ChatClient(server)
+    silent.send('ping', 'on')
+    silent.join('silent')
+
+    time.sleep(4)
+    silent_frames = silent.drain()
+    assert any(message_type == 'ping' for message_type, _ in silent_frames)
+    assert silent.closed
+    assert not any(message_type == 'ping' for message_type, _ in legacy.drain())
+    assert not legacy.closed
+
+
+METRICS_PORT = free_port()
+
+
+@pytest.mark.parametrize('server', [{'heartbeat_interval': 1, 'metrics_port': METRICS_PORT}], indirect=True)
+def test_ping_time_is_measured_by_the_server(server):
+    client = ChatClient(server)
+    client.send('ping', 'on')
+    client.join('pinger')
+    # a pong nobody asked for and a forged echo of the ping both count for nothing
+    client.send('pong', '1e300')
+    client.wait_for(lambda message_type, content: message_type == 'ping', timeout=5)
+    client.send('pong', 'nan')
+    time.sleep(0.2)
+
+    with urllib.request.urlopen(f'http://127.0.0.1:{METRICS_PORT}/metrics') as response:
+        lines = response.read().decode('utf8').splitlines()
+    values = {line.split(' ')[0]: float(line.split(' ')[1]) for line in lines if line.startswith('chatter_ping_seconds_')}
+    assert values['chatter_ping_seconds_count'] == 1
+    assert 0 <= values['chatter_ping_seconds_sum'] < 1
+
+
+LIMITS = {'messages_per_second': 10, 'messages_burst': 20, 'bytes_per_second': 0, 'bytes_burst': 0,
+          'ip_messages_per_second': 0, 'ip_messages_burst': 0, 'ip_bytes_per_second': 0, 'ip_bytes_burst': 0}
+
+
+@pytest.mark.parametrize('server', [{'rate_limits': {'user': LIMITS, 'admin': LIMITS}}], indirect=True)
+def test_frames_over_the_message_limit_wait_for_the_bucket(server):
+    watcher = ChatClient(server)
+    watcher.join('watcher')
+    sender = ChatClient(server)
+    sender.join('sender')
+    watcher.drain()
+
+    sender.sock.sendall(b''.join(f'text{sender.splitter}line {i}{sender.splitter}end{sender.splitter}'.encode('utf8') for i in range(40)))
+    # the burst, the line that goes into debt and what 0.3 seconds of refill allow
+    early = [content for message_type, content in watcher.collect(0.3) if message_type == 'room']
+    assert 20 <= len(early) <= 25
+
+    time.sleep(2.5)
+    lines = early + [content for message_type, content in watcher.drain() if message_type == 'room']
+    assert lines == [f'lobby sender: line {i}' for i in range(40)]
@@ -0,0 +1,36 @@
+import math
+
+
+# a hashed timer wheel: one set of items per tick, scheduling and cancelling are a dict and a set operation
+# delays longer than the wheel are cut to one turn, so whoever expires an item has to check it is really due
+class TimerWheel:
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current = 0
+        # slot index of every scheduled item
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def schedule(self, item, delay):
+        self.cancel(item)
+        ticks = min(len(self.slots) - 1, max(1, math.ceil(delay / self.tick)))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot].add(item)
+        self.positions[item] = slot
+
+    def cancel(self, item):
+        slot = self.positions.pop(item, None)
+        if slot is not None:
+            self.slots[slot].discard(item)
+
+    # moves the wheel one tick on and returns the items that expired
+    def advance(self):
+        self.current = (self.current + 1) % len(self.slots)
+        expired = self.slots[self.current]
+        self.slots[self.current] = set()
+        for item in expired:
+            del self.positions[item]
+        return expired